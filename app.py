@@ -1,112 +1,98 @@
 from flask import Flask, request, jsonify, render_template  # Add render_template
 import os
+import json
+import logging
+import shutil
+import tempfile
+import time
 import traceback
+from datetime import datetime, timezone
+from functools import wraps
 import cv2
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
-from omr_logic.evaluation import evaluate_omr_sheet
-import sqlite3
+from omr_logic.admission import Overloaded, get_admission_controller
+from omr_logic.engine import GradingEngine, score_warnings, validate_filename
+from omr_logic.jobs import submit_job, get_job, queue_depth, start_workers
+from omr_logic.batch import file_extension, iter_graded, iter_zip_items, parse_manifest
+from omr_logic.pages import PAGED_EXTENSIONS, PDF_SUPPORT, iter_page_items
+from omr_logic.db import WriteQueueFull, get_connection, get_writer, query_results, version_stats
+from omr_logic.items import item_stats
+from omr_logic.regrade import regrade_version
+from omr_logic.metrics import (timed, record_spans, render_metrics,
+                               SHEETS_TOTAL, REQUEST_SECONDS, REQUESTS_TOTAL)
+
+# OMR_LOG_LEVEL=DEBUG logs every detected answer; the default INFO logs one line per sheet
+logging.basicConfig(level=os.environ.get('OMR_LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_BATCH_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512MB max batch request
+# Uploads are decoded in memory; set OMR_SAVE_UPLOADS=1 to go through a
+# temp file in UPLOAD_FOLDER instead (useful when debugging a bad sheet)
+app.config['SAVE_UPLOADS'] = os.environ.get('OMR_SAVE_UPLOADS') == '1'
+
+# Results are committed in batches by a background writer; set OMR_DB_SYNC=1
+# (or send sync=1 with a request) to wait for the commit before responding
+app.config['DB_SYNC_WRITES'] = os.environ.get('OMR_DB_SYNC') == '1'
 
-# Create uploads folder if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# Answer keys with subject names as keys
-ANSWER_KEYS = {
-    'A': {
-        "Python": [0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3],
-        "Data Analysis": [1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0],
-        "MySQL": [2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1],
-        "PowerBI": [3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2, 3, 0, 1, 2],
-        "Adv Stats": [0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3]
-    },
-    'B': {
-        "Python": [1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2],
-        "Data Analysis": [2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3],
-        "MySQL": [3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0],
-        "PowerBI": [0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3, 2, 1],
-        "Adv Stats": [1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2]
-    },
-    'C': {
-        "Python": [2, 3, 1, 0, 2, 3, 1, 0, 2, 3, 1, 0, 2, 3, 1, 0, 2, 3, 1, 0],
-        "Data Analysis": [3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1, 3, 0, 2, 1],
-        "MySQL": [0, 1, 3, 2, 0, 1, 3, 2, 0, 1, 3, 2, 0, 1, 3, 2, 0, 1, 3, 2],
-        "PowerBI": [1, 2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3],
-        "Adv Stats": [2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3, 1, 2, 0, 3, 1]
-    }
-}
+# Re-submitted sheets are answered from a result cache keyed on the image
+# bytes and answer key; OMR_RESULT_CACHE=0 turns it off
+app.config['RESULT_CACHE'] = os.environ.get('OMR_RESULT_CACHE', '1') != '0'
+
+# Grades /api/upload sheets (and initialises the database). Answer keys are
+# loaded from data/answer_keys.json and reloaded when the file changes
+engine = GradingEngine(result_cache=app.config['RESULT_CACHE'],
+                       cache_size=int(os.environ.get('OMR_RESULT_CACHE_SIZE', '1024')),
+                       save_uploads=app.config['UPLOAD_FOLDER'] if app.config['SAVE_UPLOADS'] else None)
+answer_keys = engine.answer_keys
+result_cache = engine.result_cache
 
 def get_db_connection():
-    conn = sqlite3.connect('results.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS results (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            student_id TEXT NOT NULL,
-            sheet_version TEXT NOT NULL,
-            subject1_score INTEGER,
-            subject2_score INTEGER,
-            subject3_score INTEGER,
-            subject4_score INTEGER,
-            subject5_score INTEGER,
-            total_score INTEGER,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        );
-    ''')
-    conn.commit()
-    conn.close()
+    # Reused per thread; WAL mode lets reads run alongside the result writer
+    return get_connection()
 
 def validate_file_type(file):
     if not file:
         return False, "No file provided"
-    
-    if file.filename == '':
-        return False, "Empty filename"
-    
-    allowed_extensions = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'gif'}
-    file_ext = file.filename.lower().split('.')[-1] if '.' in file.filename else ''
-    
-    if file_ext not in allowed_extensions:
-        return False, f"Invalid file type '{file_ext}'. Allowed formats: JPG, JPEG, PNG, BMP, TIFF"
-    
-    return True, "Valid file type"
-
-def basic_image_validation(filepath):
-    try:
-        image = cv2.imread(filepath)
-        if image is None:
-            return False, "Cannot read image file. File may be corrupted."
-        
-        height, width = image.shape[:2]
-        
-        if width < 100 or height < 100:
-            return False, f"Image too small ({width}x{height}). Please use a larger image."
-        
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        mean_intensity = np.mean(gray)
-        std_intensity = np.std(gray)
-        
-        if std_intensity < 1:
-            return False, "Image appears to be completely uniform (no content detected)."
-        
-        if mean_intensity > 254:
-            return False, "Image is completely white."
-        
-        if mean_intensity < 1:
-            return False, "Image is completely black."
-        
-        return True, f"Image accepted for processing (size: {width}x{height}, brightness: {mean_intensity:.0f})"
-    except Exception as e:
-        return False, f"Error processing image: {str(e)}"
+    return validate_filename(file.filename)
+
+def wants_sync_write():
+    """Whether this request should wait for its result to be committed."""
+    return app.config['DB_SYNC_WRITES'] or request.values.get('sync', '').lower() in ('1', 'true', 'yes')
+
+def keep_upload(file, named=False):
+    """
+    Copy an uploaded file into a temp file that outlives the request, so
+    a streamed response can keep reading it after Flask closes the upload.
+    With `named=True` the file has a path that pool workers can open; it
+    is deleted when closed.
+    """
+    spool = tempfile.NamedTemporaryFile() if named else tempfile.TemporaryFile()
+    shutil.copyfileobj(file.stream, spool)
+    spool.seek(0)
+    return spool
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # For streamed responses this measures time to the first byte
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        REQUESTS_TOTAL.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
@@ -115,166 +101,553 @@ def index():
 @app.route('/api/versions')
 def get_versions():
     try:
-        return jsonify(list(ANSWER_KEYS.keys()))
+        return jsonify(answer_keys.versions())
     except Exception as e:
         app.logger.error(f"Error in get_versions: {str(e)}")
         app.logger.error(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+def admitted(view):
+    """
+    Run `view` only while holding an admission slot. Requests beyond the
+    concurrency and queue limits get a 503 with Retry-After before their
+    body is read.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = get_admission_controller()
+        if controller is None:
+            return view(*args, **kwargs)
+        try:
+            with controller.admit():
+                return view(*args, **kwargs)
+        except Overloaded as e:
+            SHEETS_TOTAL.inc(route='upload', outcome='overloaded')
+            response = jsonify({
+                'error': 'Server busy',
+                'error_type': 'OVERLOADED',
+                'details': f'Too many sheets are being evaluated; retry in {e.retry_after} seconds',
+                'retry_after': e.retry_after,
+                'suggestions': [
+                    'Wait a few seconds and upload the sheet again',
+                    'Use /api/upload/batch or /api/jobs for many sheets at once'
+                ]
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+    return wrapper
+
 @app.route('/api/upload', methods=['POST'])
+@admitted
 def upload_sheet():
-    filepath = None
+    with timed('receive'):
+        # Accessing request.files parses the whole multipart body
+        has_file = 'file' in request.files
+
+    if not has_file:
+        return jsonify({
+            'error': 'No file uploaded',
+            'error_type': 'VALIDATION_ERROR',
+            'suggestions': ['Please select an image file to upload']
+        }), 400
+
+    file = request.files['file']
+    body, status = engine.grade(file.read(), file.filename, request.form.get('student_id'),
+                                request.form.get('version'), sync=wants_sync_write())
+    response = jsonify(body)
+    response.status_code = status
+    if 'retry_after' in body:
+        response.headers['Retry-After'] = str(body['retry_after'])
+    return response
+
+def stream_graded(items, spools, route='batch'):
+    """
+    Grade batch items and stream one NDJSON line per sheet, then a
+    summary line. `spools` are closed once the stream ends.
+    """
+    # One key snapshot for the whole batch
+    keys = answer_keys.snapshot()
+    sync_write = wants_sync_write()
+
+    def generate():
+        succeeded = failed = 0
+        graded = iter_graded(items, keys, cache=result_cache)
+        try:
+            for result in graded:
+                record_spans(result.pop('timings', None))
+                answers = result.pop('answers', None)
+                image_hash = result.pop('image_hash', None)
+                if result['status'] == 'success':
+                    answer_key = keys[result['version']]
+                    try:
+                        engine.save_result(result['student_id'], result['version'], answer_key,
+                                           result['scores'], result['total_score'], answers, image_hash)
+                    except Exception as db_error:
+                        result = {**result, 'status': 'error', 'error': 'System Error',
+                                  'error_type': 'PROCESSING_ERROR', 'details': str(db_error)}
+                    else:
+                        result['max_possible_score'] = answer_key.max_score
+                        warnings = score_warnings(result['total_score'])
+                        if warnings:
+                            result['warnings'] = warnings
+
+                if result['status'] == 'success':
+                    succeeded += 1
+                    SHEETS_TOTAL.inc(route=route, outcome='success')
+                else:
+                    failed += 1
+                    SHEETS_TOTAL.inc(route=route, outcome=result['error_type'].lower())
+                yield json.dumps(result) + '\n'
+
+        except Exception as e:
+            app.logger.exception("Batch aborted")
+            yield json.dumps({'status': 'aborted', 'error': 'System Error', 'details': str(e)}) + '\n'
+
+        finally:
+            # Stop the pool work first: pages still being graded read the spooled file
+            graded.close()
+            for spool in spools:
+                spool.close()
+
+        summary = {'status': 'done', 'total': succeeded + failed, 'succeeded': succeeded, 'failed': failed}
+        if sync_write:
+            try:
+                get_writer(engine.db_path).flush()
+            except (TimeoutError, WriteQueueFull):
+                # Still queued, not lost; see GradingEngine._success
+                summary['storage'] = 'pending'
+
+        yield json.dumps(summary) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Grade many sheets in one request and stream one NDJSON line per sheet.
+
+    Accepts either an `archive` ZIP holding the images plus manifest.csv /
+    manifest.json, or a multipart list of `files` with matching
+    `student_id` entries (or a `manifest` file). A single `version` value
+    applies to every sheet that does not name its own.
+    """
+    request.max_content_length = app.config['MAX_BATCH_CONTENT_LENGTH']
+    spools = []
+
+    try:
+        default_versions = request.form.getlist('version')
+        default_version = default_versions[0] if len(default_versions) == 1 else None
+
+        if 'archive' in request.files:
+            spools.append(keep_upload(request.files['archive']))
+            items = iter_zip_items(spools[0], default_version)
+        else:
+            files = [f for f in request.files.getlist('files') if f and f.filename]
+            if not files:
+                return jsonify({
+                    'error': 'No files uploaded',
+                    'error_type': 'VALIDATION_ERROR',
+                    'suggestions': ['Upload a ZIP archive with a manifest, or a list of image files']
+                }), 400
+
+            manifest = {}
+            if 'manifest' in request.files:
+                manifest_file = request.files['manifest']
+                manifest = parse_manifest(manifest_file.filename, manifest_file.read().decode('utf-8-sig'))
+
+            student_ids = request.form.getlist('student_id')
+            if not manifest and len(student_ids) != len(files):
+                return jsonify({
+                    'error': 'Missing required information',
+                    'error_type': 'VALIDATION_ERROR',
+                    'details': 'Send one student_id per file, or a manifest file'
+                }), 400
+            if not manifest and default_version is None and len(default_versions) != len(files):
+                return jsonify({
+                    'error': 'Missing required information',
+                    'error_type': 'VALIDATION_ERROR',
+                    'details': 'Send one version for the whole batch, or one per file'
+                }), 400
+
+            spools = [keep_upload(file) for file in files]
+
+            def iter_form_items():
+                for index, (file, spool) in enumerate(zip(files, spools)):
+                    if manifest:
+                        entry = manifest.get(file.filename, {})
+                    else:
+                        entry = {
+                            'student_id': student_ids[index],
+                            'version': default_version or default_versions[index],
+                        }
+                    yield {
+                        'index': index,
+                        'filename': secure_filename(file.filename),
+                        'student_id': entry.get('student_id'),
+                        'version': entry.get('version') or default_version,
+                        'data': spool.read(),
+                    }
+
+            items = iter_form_items()
+
+    except Exception as e:
+        for spool in spools:
+            spool.close()
+        return jsonify({
+            'error': 'Invalid batch',
+            'error_type': 'VALIDATION_ERROR',
+            'details': str(e)
+        }), 400
+
+    return stream_graded(items, spools)
+
+@app.route('/api/upload/pages', methods=['POST'])
+def upload_pages():
+    """
+    Grade a multi-page TIFF or PDF from a document scanner, one sheet per
+    page, streaming one NDJSON line per page as it is graded.
+
+    Students are assigned to pages by a `roster` file (CSV/JSON with
+    `page`, `student_id` and optionally `version`) or by one
+    `student_id` form value per page, in page order. A single `version`
+    applies to every page the roster does not assign one.
+    """
+    request.max_content_length = app.config['MAX_BATCH_CONTENT_LENGTH']
+    file = request.files.get('file')
+    kind = file_extension(file.filename) if file and file.filename else ''
+    if kind not in PAGED_EXTENSIONS:
+        return jsonify({
+            'error': 'Invalid file type',
+            'error_type': 'FILE_TYPE_ERROR',
+            'details': f"Expected a multi-page TIFF or PDF, got '{kind or 'no file'}'",
+            'suggestions': ['Upload the scanner output as .tif, .tiff or .pdf']
+        }), 400
+    if kind == 'pdf' and not PDF_SUPPORT:
+        return jsonify({
+            'error': 'PDF not supported',
+            'error_type': 'FILE_TYPE_ERROR',
+            'details': 'PDF scans need the optional pypdfium2 package, which is not installed on this server',
+            'suggestions': ['Upload the scanner output as a multi-page TIFF',
+                            'Or install PDF support: pip install pypdfium2']
+        }), 400
+
+    spools = []
+    try:
+        if 'roster' in request.files:
+            roster_file = request.files['roster']
+            roster = parse_manifest(roster_file.filename, roster_file.read().decode('utf-8-sig'), key='page')
+        else:
+            roster = {str(page): {'student_id': student_id}
+                      for page, student_id in enumerate(request.form.getlist('student_id'), 1)}
+        if not roster:
+            return jsonify({
+                'error': 'Missing required information',
+                'error_type': 'VALIDATION_ERROR',
+                'details': 'Send a roster file, or one student_id per page'
+            }), 400
+
+        spools.append(keep_upload(file, named=True))
+        items = iter_page_items(spools[0].name, 'pdf' if kind == 'pdf' else 'tiff',
+                                secure_filename(file.filename), roster, request.form.get('version'))
+
+    except Exception as e:
+        for spool in spools:
+            spool.close()
+        return jsonify({
+            'error': 'Invalid batch',
+            'error_type': 'VALIDATION_ERROR',
+            'details': str(e)
+        }), 400
+
+    return stream_graded(items, spools, route='pages')
+
+RESULTS_PAGE_SIZE = 50
+RESULTS_MAX_PAGE_SIZE = 500
+
+def parse_timestamp_arg(name):
+    """
+    Read an ISO date or datetime query argument in the stored timestamp
+    format ('YYYY-MM-DD HH:MM:SS', UTC). A value with a UTC offset is
+    converted to UTC; one without is taken as UTC. Raises ValueError on
+    anything else.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/api/results')
+def list_results():
+    """
+    Page through stored results, newest first. Filters: student_id,
+    version, since, until. Pass the returned `next_cursor` as `cursor`
+    to fetch the following page.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', RESULTS_PAGE_SIZE)), 1), RESULTS_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        before_id = int(cursor) if cursor else None
+        since = parse_timestamp_arg('since')
+        until = parse_timestamp_arg('until')
+    except ValueError as e:
+        return jsonify({
+            'error': 'Invalid query parameter',
+            'error_type': 'VALIDATION_ERROR',
+            'details': str(e),
+            'suggestions': [
+                'limit and cursor must be integers',
+                'since and until take ISO dates, e.g. 2024-05-01 or 2024-05-01T09:30:00'
+            ]
+        }), 400
+
+    try:
+        rows, next_cursor = query_results(
+            get_db_connection(),
+            student_id=request.args.get('student_id'),
+            version=request.args.get('version'),
+            since=since,
+            until=until,
+            before_id=before_id,
+            limit=limit,
+        )
+        return jsonify({'results': rows, 'next_cursor': next_cursor})
+    except Exception as e:
+        app.logger.error(f"Error in list_results: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({'error': str(e), 'error_type': 'SYSTEM_ERROR'}), 500
+
+@app.route('/api/results/stats')
+def results_stats():
+    """
+    Per-version score summary (count, mean and standard deviation per
+    subject and overall, total-score histogram), read from the aggregate
+    tables instead of scanning results.
+    """
+    version = request.args.get('version')
+    if not version:
+        return jsonify({
+            'error': 'Missing required information',
+            'error_type': 'VALIDATION_ERROR',
+            'details': 'Pass the exam version to summarise, e.g. ?version=A'
+        }), 400
+
+    try:
+        stats = version_stats(get_db_connection(), version)
+        if stats is None:
+            return jsonify({
+                'error': 'No results',
+                'error_type': 'NOT_FOUND',
+                'details': f'No graded sheets for version "{version}"'
+            }), 404
+
+        # Name the subject columns after the version's answer key, if it is still loaded
+        answer_key = answer_keys.get(version)
+        columns = list(stats['columns'].values())
+        if answer_key is not None:
+            names = list(answer_key.subjects)[:5]
+        else:
+            names = [f'subject{i}' for i in range(1, len(columns) + 1)]
+        subjects = {name: {'mean': mean, 'std': std} for name, (mean, std) in zip(names, columns)}
+
+        mean, std = stats['total']
+        return jsonify({
+            'version': version,
+            'count': stats['count'],
+            'total': {'mean': mean, 'std': std},
+            'subjects': subjects,
+            'histogram': stats['histogram'],
+        })
+    except Exception as e:
+        app.logger.error(f"Error in results_stats: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({'error': str(e), 'error_type': 'SYSTEM_ERROR'}), 500
+
+@app.route('/api/results/items')
+def results_items():
+    """
+    Per-question item analysis for one version (difficulty,
+    discrimination and option frequencies), read from the item_stats
+    counters instead of scanning results.
+    """
+    version = request.args.get('version')
+    if not version:
+        return jsonify({
+            'error': 'Missing required information',
+            'error_type': 'VALIDATION_ERROR',
+            'details': 'Pass the exam version to analyse, e.g. ?version=A'
+        }), 400
+
+    answer_key = answer_keys.get(version)
+    if answer_key is None:
+        return jsonify({
+            'error': 'Invalid exam version',
+            'error_type': 'VALIDATION_ERROR',
+            'details': f'Version "{version}" not found'
+        }), 400
+
+    try:
+        stats = item_stats(get_db_connection(), version, answer_key)
+        if stats is None:
+            return jsonify({
+                'error': 'No results',
+                'error_type': 'NOT_FOUND',
+                'details': f'No graded sheets with stored answers for version "{version}"'
+            }), 404
+        return jsonify(stats)
+    except Exception as e:
+        app.logger.error(f"Error in results_items: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({'error': str(e), 'error_type': 'SYSTEM_ERROR'}), 500
+
+@app.route('/api/results/regrade', methods=['POST'])
+def regrade_results():
+    """
+    Rescore every stored result of a version against its current answer
+    key, from the stored answers, and report the score changes. Pass
+    dry_run=1 to see the report without updating anything.
+    """
+    version = request.values.get('version')
+    if not version:
+        return jsonify({
+            'error': 'Missing required information',
+            'error_type': 'VALIDATION_ERROR',
+            'details': 'Pass the exam version to re-grade, e.g. version=B'
+        }), 400
+
+    answer_key = answer_keys.get(version)
+    if answer_key is None:
+        return jsonify({
+            'error': 'Invalid exam version',
+            'error_type': 'VALIDATION_ERROR',
+            'details': f'Version "{version}" not found'
+        }), 400
+
+    try:
+        # Rows still queued on the writer were graded too and must be included
+        get_writer(engine.db_path).flush()
+        dry_run = request.values.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        return jsonify(regrade_version(get_db_connection(), version, answer_key, dry_run=dry_run))
+    except Exception as e:
+        app.logger.error(f"Error in regrade_results: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({'error': str(e), 'error_type': 'SYSTEM_ERROR'}), 500
+
+JOB_EVENTS_POLL_INTERVAL = 0.25
+JOB_EVENTS_KEEPALIVE = 15
+# Each open event stream holds a request thread, so streams end after this
+# many seconds and clients reconnect
+JOB_EVENTS_TIMEOUT = int(os.environ.get('OMR_JOB_EVENTS_TIMEOUT', '300'))
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """
+    Queue one sheet for grading and return its job id straight away. The
+    sheet is graded by a job worker (python -m omr_logic.jobs); poll
+    /api/jobs/<id> or follow /api/jobs/<id>/events for the result.
+    """
     try:
-        print("Upload request received")
-        
         if 'file' not in request.files:
             return jsonify({
                 'error': 'No file uploaded',
                 'error_type': 'VALIDATION_ERROR',
                 'suggestions': ['Please select an image file to upload']
             }), 400
-        
+
         file = request.files['file']
-        
         is_valid_type, type_message = validate_file_type(file)
         if not is_valid_type:
             return jsonify({
                 'error': 'Invalid file type',
                 'error_type': 'FILE_TYPE_ERROR',
-                'details': type_message,
-                'suggestions': [
-                    'Upload a valid image file (JPG, PNG, BMP, TIFF)',
-                    'Ensure the file extension is correct'
-                ]
+                'details': type_message
             }), 400
 
         student_id = request.form.get('student_id')
         version = request.form.get('version')
-        
         if not student_id or not version:
             return jsonify({
                 'error': 'Missing required information',
                 'error_type': 'VALIDATION_ERROR',
                 'details': 'Both student ID and version are required'
             }), 400
-        
-        if version not in ANSWER_KEYS:
+        if version not in answer_keys:
             return jsonify({
                 'error': 'Invalid exam version',
                 'error_type': 'VALIDATION_ERROR',
                 'details': f'Version "{version}" not found'
             }), 400
 
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        print(f"File saved: {filepath}")
-        
-        is_valid_image, validation_message = basic_image_validation(filepath)
-        print(f"Validation result: {is_valid_image}, Message: {validation_message}")
-        
-        if not is_valid_image:
-            return jsonify({
-                'error': 'Invalid Image',
-                'error_type': 'INVALID_IMAGE',
-                'details': validation_message,
-                'student_id': student_id,
-                'version': version,
-                'suggestions': [
-                    'Please upload a clear, readable image',
-                    'Ensure the image is not corrupted',
-                    'Try taking a new photo with better quality',
-                    'Make sure the image file is valid'
-                ]
-            }), 400
-        
-        answer_key = ANSWER_KEYS.get(version)
-        print(f"Processing evaluation for student: {student_id}, version: {version}")
-        
-        try:
-            scores, total_score = evaluate_omr_sheet(filepath, answer_key)
-            print(f"Evaluation completed successfully - Total score: {total_score}")
-            
-        except Exception as eval_error:
-            print(f"Evaluation error: {eval_error}")
-            print(traceback.format_exc())
-            
-            return jsonify({
-                'error': 'OMR Processing Failed',
-                'error_type': 'EVALUATION_ERROR',
-                'details': f'Could not evaluate the OMR sheet: {str(eval_error)}',
-                'student_id': student_id,
-                'version': version,
-                'suggestions': [
-                    'Make sure the image shows a complete OMR sheet',
-                    'Ensure bubbles are clearly visible and properly filled',
-                    'Check that the image is not rotated or skewed',
-                    'Try uploading a clearer image of the OMR sheet',
-                    'Verify that the sheet contains the expected bubble pattern'
-                ]
-            }), 500
-        
-        # --- FIX: MAP SUBJECT NAMES TO GENERIC DB COLUMNS ---
-        subject_names = list(answer_key.keys())
-        # The correct way to prepare scores for the database insertion
-        subject_scores_list = [scores.get(name) for name in subject_names]
+        with timed('job_submit'):
+            job_id = submit_job(get_db_connection(), file.read(), secure_filename(file.filename),
+                                student_id, version)
 
-        conn = get_db_connection()
-        conn.execute('INSERT INTO results (student_id, sheet_version, subject1_score, subject2_score, subject3_score, subject4_score, subject5_score, total_score) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                     (student_id, version, *subject_scores_list, total_score))
-        conn.commit()
-        conn.close()
-
-        warnings = []
-        if total_score == 0:
-            warnings.append("No correct answers detected - please verify the answer key or bubble filling")
-        elif total_score < 5:
-            warnings.append("Very low score detected - please check if bubbles are properly filled")
-        
-        # FIX: Correctly calculate the max possible score by summing the lengths of all subject lists
-        total_questions = sum(len(q_list) for q_list in answer_key.values())
-
-        response_data = {
-            'student_id': student_id,
-            'version': version,
-            'scores': scores,
-            'total_score': total_score,
-            'max_possible_score': total_questions,
-            'evaluation_status': 'success',
-            'image_info': validation_message
-        }
-        
-        if warnings:
-            response_data['warnings'] = warnings
-            
-        print(f"Returning successful response: {response_data}")
-        return jsonify(response_data)
-        
-    except Exception as e:
-        print(f"Unexpected exception occurred: {str(e)}")
-        print(traceback.format_exc())
-        
         return jsonify({
-            'error': 'System Error',
-            'error_type': 'PROCESSING_ERROR',
-            'details': str(e),
-            'suggestions': [
-                'Try uploading the image again',
-                'Ensure the image file is not corrupted',
-                'Contact support if the problem persists'
-            ]
-        }), 500
-        
-    finally:
-        if filepath and os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-                print(f"Cleaned up file: {filepath}")
-            except Exception as cleanup_error:
-                print(f"Failed to cleanup file {filepath}: {cleanup_error}")
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': f'/api/jobs/{job_id}',
+            'events_url': f'/api/jobs/{job_id}/events',
+        }), 202
+
+    except Exception as e:
+        app.logger.error(f"Error in create_job: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({'error': 'System Error', 'error_type': 'PROCESSING_ERROR', 'details': str(e)}), 500
+
+@app.route('/api/jobs/stats')
+def job_stats():
+    return jsonify(queue_depth(get_db_connection()))
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(get_db_connection(), job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'error_type': 'NOT_FOUND'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Server-sent events for one job: an event named after each status the
+    job passes through, ending with `done` or `failed`; `gone` if the job
+    is deleted meanwhile, or `timeout` after JOB_EVENTS_TIMEOUT seconds.
+    """
+    if get_job(get_db_connection(), job_id) is None:
+        return jsonify({'error': 'Job not found', 'error_type': 'NOT_FOUND'}), 404
+
+    def generate():
+        conn = get_db_connection()
+        last_status = None
+        last_sent = started = time.monotonic()
+        while True:
+            job = get_job(conn, job_id)
+            if job is None:
+                yield f"event: gone\ndata: {json.dumps({'id': job_id})}\n\n"
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                last_sent = time.monotonic()
+                yield f"event: {last_status}\ndata: {json.dumps(job)}\n\n"
+            if last_status in ('done', 'failed'):
+                return
+            if time.monotonic() - started > JOB_EVENTS_TIMEOUT:
+                yield "event: timeout\ndata: {}\n\n"
+                return
+            if time.monotonic() - last_sent > JOB_EVENTS_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(JOB_EVENTS_POLL_INTERVAL)
 
-init_db()
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 if __name__== '__main__':
+    # OMR_JOB_WORKERS=N also runs N job workers next to the dev server
+    # (only in the reloader's child, so they are not started twice)
+    job_workers = int(os.environ.get('OMR_JOB_WORKERS') or 0)
+    if job_workers and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_workers(job_workers)
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,50 @@
+"""
+Production gunicorn settings:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (so init_db and the answer keys
+load once) and forked into workers. Each worker's OpenCV and BLAS thread
+pools get an even share of OMR_CPU_BUDGET, so concurrent requests do not
+oversubscribe the cores, and it grades one synthetic sheet before taking
+traffic so the first real request is not a cold start.
+"""
+import os
+import sys
+
+from omr_logic.runtime import configure_threads, cpu_budget, limit_native_threads, threads_per_worker, warm_up
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY') or cpu_budget())
+# Uploads each worker evaluates at once, and may hold waiting for a slot
+# (see omr_logic.admission)
+max_concurrent = int(os.environ.get('OMR_MAX_CONCURRENT') or 4)
+admission_queue = int(os.environ.get('OMR_ADMISSION_QUEUE') or max_concurrent)
+# Threads beyond those keep streaming responses (batch NDJSON, job events)
+# from holding a whole worker, and let a burst past the wait queue reach
+# the app to get its 503 instead of sitting in the listen backlog
+worker_class = 'gthread'
+threads = int(os.environ.get('OMR_WEB_THREADS') or max_concurrent + admission_queue + 4)
+timeout = 120
+preload_app = True
+
+# Only the admitted uploads run the pipeline, so they share the native threads
+native_threads = threads_per_worker(workers, max_concurrent or threads)
+
+# Must happen before the app (and with it numpy) is preloaded
+limit_native_threads(native_threads)
+# Batch grading pools are forked lazily from whichever worker gets a batch.
+# Batches are rare and bursty, so one pool may use the whole budget; two
+# batches at once on different workers share the cores by time-slicing
+os.environ.setdefault('OMR_BATCH_WORKERS', str(cpu_budget()))
+os.environ.setdefault('OMR_MAX_CONCURRENT', str(max_concurrent))
+os.environ.setdefault('OMR_ADMISSION_QUEUE', str(admission_queue))
+
+
+def post_fork(server, worker):
+    configure_threads(native_threads)
+    app_module = sys.modules.get('app')
+    try:
+        warm_up(getattr(app_module, 'answer_keys', None))
+    except Exception as e:
+        server.log.warning("Warm-up failed in worker %s: %s", worker.pid, e)
@@ -0,0 +1,281 @@
+"""
+Grade a folder of scanned sheets from the command line.
+
+    python -m omr_logic scans/ --roster roster.csv --out results.csv
+    python -m omr_logic "scans/**/*.jpg" --roster roster.csv --out results.jsonl --db results.db
+
+The roster is a CSV (or JSON) manifest with `filename`, `student_id` and
+optionally `version` columns, as for batch uploads. Files are read (and,
+with --workers 0, decoded) by a small thread pool ahead of the graders,
+graded on a process pool, and written in input order. At most
+--max-in-flight sheets are being graded at once, plus two per reader
+thread prefetched. Re-running with --resume appends to the output and
+skips sheets it already records as graded.
+
+The output file is the one record of progress: with --db, a sheet is
+written to it only once its row is committed. A sheet stored but not yet
+recorded when a run stops is graded again on resume, and not stored
+twice (results are unique per image, student and version).
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from .answer_keys import ANSWER_KEYS_PATH, AnswerKeyRegistry
+from .batch import IMAGE_EXTENSIONS, check_item, file_extension, grade_sheet_bytes, parse_manifest
+from .cache import image_digest
+from .db import DB_PATH, ResultWriter, init_db, result_row
+from .layout import compile_layout
+from .registration import enable_registration_cache
+from .runtime import init_scan_worker
+from .utils import decode_image
+
+logger = logging.getLogger('omr_logic.cli')
+
+CSV_FIELDS = ['filename', 'student_id', 'version', 'status', 'total_score', 'max_possible_score']
+CSV_TAIL_FIELDS = ['error_type', 'details']
+
+
+def find_images(source):
+    """Sorted image paths from a directory (recursively) or a glob pattern."""
+    if os.path.isdir(source):
+        paths = (os.path.join(root, name) for root, _, names in os.walk(source) for name in names)
+        base = source
+    else:
+        paths = glob.glob(source, recursive=True)
+        base = os.path.dirname(source.split('*', 1)[0]) or '.'
+    return base, sorted(p for p in paths if file_extension(p) in IMAGE_EXTENSIONS)
+
+
+def load_roster(path):
+    with open(path, encoding='utf-8-sig') as f:
+        return parse_manifest(path, f.read())
+
+
+def graded_filenames(out_path, fmt):
+    """Filenames an earlier run already graded successfully."""
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, newline='') as f:
+        if fmt == 'jsonl':
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by the interruption
+                if record.get('status') == 'success':
+                    done.add(record.get('filename'))
+        else:
+            for record in csv.DictReader(f):
+                if record.get('status') == 'success':
+                    done.add(record.get('filename'))
+    return done
+
+
+def prefetch(tasks, fn, threads, depth):
+    """
+    Yield fn(task) for each task in order, running up to `depth` calls
+    ahead on a thread pool. File reads and cv2.imdecode release the GIL,
+    so this overlaps I/O and decoding with grading.
+    """
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='omr-prefetch') as pool:
+        window = deque()
+        for task in tasks:
+            window.append(pool.submit(fn, task))
+            if len(window) >= depth:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+class ResultSink:
+    """
+    Writes results in input order to CSV or JSONL, and optionally the
+    results DB. With a DB, each result is written out only after its row
+    has been committed; a row that fails to commit is written as an error,
+    so --resume grades that sheet again.
+    """
+
+    def __init__(self, out_path, fmt, subjects, append=False, db_path=None):
+        exists = append and os.path.exists(out_path) and os.path.getsize(out_path) > 0
+        self.file = open(out_path, 'a' if append else 'w', newline='', buffering=1)
+        self.fmt = fmt
+        self.subjects = subjects
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(self.file, CSV_FIELDS + list(subjects) + CSV_TAIL_FIELDS,
+                                      extrasaction='ignore')
+            if not exists:
+                self.csv.writeheader()
+        self.writer = ResultWriter(db_path) if db_path else None
+        self.db_errors = 0
+        # (pending DB write or None, result), in input order
+        self._unrecorded = deque()
+
+    def write(self, result, answer_key=None):
+        answers = result.pop('answers', None)
+        image_hash = result.pop('image_hash', None)
+        pending = None
+        if self.writer is not None and result['status'] == 'success':
+            # Block while the database catches up, instead of failing the sheet
+            pending = self.writer.submit(result_row(result['student_id'], result['version'], answer_key,
+                                                    result['scores'], result['total_score'], answers, image_hash),
+                                         queue_timeout=None)
+        self._unrecorded.append((pending, result))
+        self._record_committed()
+
+    def _record_committed(self, block=False):
+        """Write out, in order, the results whose DB write has finished (with `block`, all of them)."""
+        while self._unrecorded:
+            pending, result = self._unrecorded[0]
+            if pending is not None:
+                if not block and not pending.done():
+                    break
+                try:
+                    pending.wait(30)
+                except Exception as e:
+                    self.db_errors += 1
+                    result = {**result, 'status': 'error', 'error': 'System Error',
+                              'error_type': 'PROCESSING_ERROR', 'details': f'Result not stored: {e}'}
+            self._unrecorded.popleft()
+            if self.csv is not None:
+                self.csv.writerow({**result, **result.get('scores', {})})
+            else:
+                self.file.write(json.dumps(result) + '\n')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self._record_committed(block=True)
+        self.file.close()
+
+
+def _read(task, decode):
+    item, path = task
+    with open(path, 'rb') as f:
+        item['data'] = f.read()
+    item['image_hash'] = image_digest(item['data'])
+    if decode:
+        item['image'] = decode_image(item.pop('data'))
+    return item
+
+
+def run(args):
+    base, paths = find_images(args.input)
+    roster = load_roster(args.roster) if args.roster else {}
+    answer_keys = AnswerKeyRegistry(args.answer_keys).snapshot()
+    if not answer_keys:
+        raise SystemExit(f'No answer keys loaded from {args.answer_keys}')
+
+    fmt = args.format or ('jsonl' if args.out.endswith('.jsonl') else 'csv')
+    done = graded_filenames(args.out, fmt) if args.resume else set()
+    if args.db:
+        init_db(args.db)
+    sink = ResultSink(args.out, fmt, compile_layout().subjects, append=args.resume, db_path=args.db)
+
+    workers = args.workers if args.workers is not None else (os.cpu_count() or 1)
+    max_in_flight = args.max_in_flight or 2 * max(workers, 1)
+
+    def tasks():
+        for index, path in enumerate(paths):
+            filename = os.path.relpath(path, base)
+            if filename in done:
+                continue
+            entry = roster.get(filename) or roster.get(os.path.basename(path)) or {}
+            yield {
+                'index': index,
+                'filename': filename,
+                'student_id': entry.get('student_id'),
+                'version': entry.get('version') or args.version,
+            }, path
+
+    counts = {'success': 0, 'error': 0}
+    start = time.perf_counter()
+    if workers > 0:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_scan_worker)
+    else:
+        pool = None
+        enable_registration_cache()
+    pending = deque()
+
+    def finish(future):
+        result = future.result()
+        result.pop('timings', None)
+        answer_key = answer_keys.get(result.get('version'))
+        if result['status'] == 'success':
+            result['max_possible_score'] = answer_key.max_score
+        sink.write(result, answer_key)
+        counts['success' if result['status'] == 'success' else 'error'] += 1
+        total = counts['success'] + counts['error']
+        if total % 100 == 0:
+            logger.info("Graded %d sheets (%.1f/s)", total, total / (time.perf_counter() - start))
+
+    try:
+        for item in prefetch(tasks(), lambda task: _read(task, decode=pool is None),
+                             threads=args.io_threads, depth=2 * args.io_threads):
+            rejected = check_item(item, answer_keys)
+            if rejected is not None:
+                future = Future()
+                future.set_result(rejected)
+            elif pool is None:
+                future = Future()
+                future.set_result(grade_sheet_bytes(item, answer_keys[item['version']]))
+            else:
+                future = pool.submit(grade_sheet_bytes, item, answer_keys[item['version']])
+            pending.append(future)
+
+            # Results are written in input order; waiting on the oldest
+            # sheet also caps how many are held in memory
+            while len(pending) >= max_in_flight:
+                finish(pending.popleft())
+        while pending:
+            finish(pending.popleft())
+    except KeyboardInterrupt:
+        logger.warning("Interrupted; rerun with --resume to continue")
+        for future in pending:
+            future.cancel()
+        return 130
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        sink.close()
+        counts['success'] -= sink.db_errors
+        counts['error'] += sink.db_errors
+
+    elapsed = time.perf_counter() - start
+    total = counts['success'] + counts['error']
+    logger.info("Graded %d sheets in %.1fs (%.1f/s): %d succeeded, %d failed, %d skipped as already graded",
+                total, elapsed, total / elapsed if elapsed else 0, counts['success'], counts['error'], len(done))
+    return 0 if counts['error'] == 0 else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m omr_logic', description='Grade a folder of OMR sheets.')
+    parser.add_argument('input', help='directory of images, or a glob pattern')
+    parser.add_argument('--roster', help='CSV/JSON manifest with filename, student_id and version')
+    parser.add_argument('--version', help='exam version for sheets the roster does not assign one')
+    parser.add_argument('--out', required=True, help='output file (.csv or .jsonl)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='output format (default: from --out)')
+    parser.add_argument('--db', nargs='?', const=DB_PATH, help=f'also store results in a database (default: {DB_PATH})')
+    parser.add_argument('--workers', type=int, help='grading processes (default: CPU count; 0 grades in-process)')
+    parser.add_argument('--io-threads', type=int, default=4, help='threads reading files ahead of the graders')
+    parser.add_argument('--max-in-flight', type=int, help='sheets held in memory at once (default: 2 x workers)')
+    parser.add_argument('--answer-keys', default=ANSWER_KEYS_PATH, help='answer key file')
+    parser.add_argument('--resume', action='store_true', help='append to --out, skipping sheets already graded')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('OMR_LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
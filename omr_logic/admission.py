@@ -0,0 +1,123 @@
+"""
+Admission control for the synchronous upload route.
+
+At most `max_concurrent` uploads are evaluated at once per process, and
+at most `max_queue` more wait for a slot (for up to `queue_timeout`
+seconds). Anything beyond that is turned away straight away, before its
+body is read or decoded, so a burst costs a quick 503 instead of another
+decoded image in memory. Rejections carry a Retry-After estimate: the
+time for the work already admitted and queued to drain, from an
+exponentially weighted moving average of recent per-sheet latency.
+
+In-flight and waiting counts, the latency average and rejections are
+exported through /metrics.
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import Counter, Gauge
+from .runtime import cpu_budget
+
+# 0 turns admission control off
+MAX_CONCURRENT = int(os.environ.get('OMR_MAX_CONCURRENT') or cpu_budget())
+MAX_QUEUE = int(os.environ.get('OMR_ADMISSION_QUEUE') or MAX_CONCURRENT)
+QUEUE_TIMEOUT = float(os.environ.get('OMR_ADMISSION_TIMEOUT', '10'))
+
+LATENCY_ALPHA = 0.2       # weight of the newest sheet in the latency average
+INITIAL_LATENCY = 1.0     # seconds per sheet assumed before any have finished
+
+ADMISSION_REJECTIONS = Counter('omr_admission_rejections_total',
+                               'Uploads turned away with 503, by reason (queue_full, timeout).')
+
+
+class Overloaded(Exception):
+    """Raised by admit() when an upload cannot be taken on now."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f'Server busy ({reason}); retry in {retry_after}s')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded concurrency with a small bounded wait queue, per process."""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency = INITIAL_LATENCY
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        """Whole seconds until the admitted and queued work should have drained."""
+        ahead = self.in_flight + self.waiting + 1
+        return max(1, math.ceil(self.latency * ahead / self.max_concurrent))
+
+    def _reject(self, reason):
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        raise Overloaded(reason, self.retry_after())
+
+    @contextmanager
+    def admit(self):
+        """
+        Context manager holding one evaluation slot. Raises Overloaded if
+        the queue is full, or no slot frees up within queue_timeout.
+        """
+        with self._cond:
+            if self.in_flight >= self.max_concurrent:
+                if self.waiting >= self.max_queue:
+                    self._reject('queue_full')
+                self.waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.in_flight >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject('timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                self.in_flight -= 1
+                self.latency += LATENCY_ALPHA * (elapsed - self.latency)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'latency_seconds': round(self.latency, 4),
+            }
+
+
+_controller = AdmissionController() if MAX_CONCURRENT > 0 else None
+
+
+def get_admission_controller():
+    """The process-wide controller, or None when OMR_MAX_CONCURRENT=0."""
+    return _controller
+
+
+ADMISSION_REQUESTS = Gauge('omr_admission_requests', 'Uploads being evaluated or waiting for a slot, by state.',
+                           fn=lambda: {state: (_controller.stats()[state] if _controller else 0)
+                                       for state in ('in_flight', 'waiting')},
+                           label='state')
+ADMISSION_LATENCY = Gauge('omr_admission_latency_seconds',
+                          'Moving average of per-sheet upload latency, used for Retry-After.',
+                          fn=lambda: _controller.latency if _controller else 0)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from .layout import compile_layout
+
+logger = logging.getLogger(__name__)
+
+ANSWER_KEYS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'answer_keys.json')
+
+# An answer key compiled against a sheet layout. `answers` holds one
+# int8 option index per layout question, -1 where the key has no entry.
+CompiledKey = namedtuple('CompiledKey', [
+    'version',
+    'layout_id',
+    'subjects',
+    'subject_index',
+    'answers',
+    'max_score',
+    'fingerprint',
+])
+
+
+def compile_answer_key(answer_key, version=None, layout_id=None):
+    """
+    Compile a {subject: [option, ...]} answer key into an int8 array
+    aligned with the sheet layout's question order.
+    """
+    if not isinstance(answer_key, dict):
+        raise ValueError(f"Answer key for version '{version}' must map subjects to option lists")
+    layout = compile_layout(layout_id)
+    answers = np.full(len(layout.boxes), -1, dtype=np.int8)
+
+    for subject, key in answer_key.items():
+        if subject not in layout.subjects:
+            raise ValueError(f"Subject '{subject}' is not on layout '{layout.layout_id}'")
+        if not isinstance(key, list):
+            raise ValueError(f"Answer key for '{subject}' must be a list of option indices")
+        subject_questions = np.flatnonzero(layout.subject_index == layout.subjects.index(subject))
+        if len(key) > len(subject_questions):
+            raise ValueError(f"Answer key for '{subject}' has {len(key)} entries, "
+                             f"layout has {len(subject_questions)} questions")
+        key = np.asarray(key, dtype=np.int8)
+        if key.size and (key.min() < 0 or key.max() >= layout.options):
+            raise ValueError(f"Answer key for '{subject}' has options outside 0-{layout.options - 1}")
+        answers[subject_questions[:len(key)]] = key
+
+    answers.flags.writeable = False
+    digest = hashlib.sha1(layout.layout_id.encode() + answers.tobytes()).hexdigest()[:16]
+
+    return CompiledKey(
+        version=version,
+        layout_id=layout.layout_id,
+        subjects=tuple(s for s in layout.subjects if s in answer_key),
+        subject_index=layout.subject_index,
+        answers=answers,
+        max_score=int(np.count_nonzero(answers >= 0)),
+        fingerprint=digest,
+    )
+
+
+def grade_answers(detected, key):
+    """
+    Score a vector of detected answers (-1 for blank) against a compiled
+    key in one vectorized comparison.
+
+    Returns ({subject: score}, total_score).
+    """
+    correct = (np.asarray(detected) == key.answers) & (key.answers >= 0)
+    layout_subjects = compile_layout(key.layout_id).subjects
+    per_subject = np.bincount(key.subject_index, weights=correct, minlength=len(layout_subjects))
+
+    scores = {name: int(per_subject[layout_subjects.index(name)]) for name in key.subjects}
+    return scores, int(np.count_nonzero(correct))
+
+
+class AnswerKeyRegistry:
+    """
+    Answer keys loaded from data/answer_keys.json and compiled against the
+    sheet layout.
+
+    The file's mtime is checked on every lookup and the keys are reloaded
+    when it changes, so edits take effect without restarting workers. A
+    reload builds a complete new mapping and swaps it in with a single
+    assignment; callers holding a key from `get` or `snapshot` keep a
+    consistent view. If the new file does not parse, the previous keys
+    stay in use and that version of the file is not read again until its
+    mtime or size changes, so a broken edit is logged once rather than on
+    every lookup.
+    """
+
+    def __init__(self, path=ANSWER_KEYS_PATH, layout_id=None):
+        self.path = path
+        self.layout_id = layout_id
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._stamp = None
+        self._failed_stamp = None
+
+    def _file_stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        try:
+            stamp = self._file_stamp()
+        except OSError as e:
+            logger.error("Cannot stat answer keys %s: %s", self.path, e)
+            return
+        if stamp in (self._stamp, self._failed_stamp):
+            return
+
+        with self._lock:
+            if stamp in (self._stamp, self._failed_stamp):
+                return
+            try:
+                with open(self.path) as f:
+                    raw = json.load(f)
+                if not isinstance(raw, dict):
+                    raise ValueError('Answer key file must map versions to answer keys')
+                keys = {
+                    version: compile_answer_key(answer_key, version, self.layout_id)
+                    for version, answer_key in raw.items()
+                }
+            except (OSError, ValueError, TypeError) as e:
+                logger.error("Failed to load answer keys from %s, keeping previous keys: %s", self.path, e)
+                self._failed_stamp = stamp
+                return
+
+            self._keys = keys
+            self._stamp = stamp
+            logger.info("Loaded answer keys for versions %s from %s", sorted(keys), self.path)
+
+    def snapshot(self):
+        """Return the current {version: CompiledKey} mapping."""
+        self._refresh()
+        return self._keys
+
+    def versions(self):
+        return list(self.snapshot().keys())
+
+    def get(self, version):
+        return self.snapshot().get(version)
+
+    def __contains__(self, version):
+        return version in self.snapshot()
@@ -0,0 +1,285 @@
+import csv
+import io
+import json
+import logging
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .cache import cache_key, image_digest
+from .evaluation import evaluate_omr_image
+from .metrics import collect_spans, timed
+from .pages import PAGED_EXTENSIONS, read_page
+from .runtime import init_scan_worker
+from .utils import decode_image
+from .validation import basic_image_validation
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'gif'}
+MANIFEST_NAMES = ('manifest.csv', 'manifest.json')
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+
+def pool_size():
+    """Number of worker processes used for batch grading."""
+    return int(os.environ.get('OMR_BATCH_WORKERS') or os.cpu_count() or 1)
+
+
+def get_pool():
+    """Return the process pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=pool_size(), initializer=init_scan_worker)
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+def file_extension(filename):
+    return filename.lower().rsplit('.', 1)[-1] if '.' in filename else ''
+
+
+def sheet_error(item, error, error_type, details):
+    result = {
+        'index': item['index'],
+        'filename': item.get('filename'),
+        'student_id': item.get('student_id'),
+        'version': item.get('version'),
+        'status': 'error',
+        'error': error,
+        'error_type': error_type,
+        'details': details,
+    }
+    if 'page' in item:
+        result['page'] = item['page']
+    return result
+
+
+def grade_sheet_bytes(item, answer_key):
+    """
+    Decode, validate and evaluate one sheet inside a pool worker.
+
+    `item` carries the raw image bytes; the bytes are not echoed back
+    so results stay small on the way back to the parent process. Stage
+    timings travel back in the result's `timings` entry, and the answers
+    read from the sheet in `answers` (for the results row; callers drop
+    it from what they send to clients).
+    """
+    with collect_spans() as spans:
+        result = _grade_sheet_bytes(item, answer_key)
+    result['timings'] = spans
+    return result
+
+
+def _grade_sheet_bytes(item, answer_key):
+    result = {k: v for k, v in item.items() if k not in ('data', 'image', 'source')}
+    try:
+        # Callers that decode ahead of time pass the array as 'image';
+        # pages of a multi-page scan are read here, one at a time
+        image = item.get('image')
+        if image is None and 'source' in item:
+            with timed('decode'):
+                image = read_page(*item['source'], item['page'])
+        elif image is None:
+            with timed('decode'):
+                image = decode_image(item['data'], layout_id=answer_key.layout_id)
+
+        with timed('validation'):
+            is_valid_image, validation_message = basic_image_validation(image)
+        if not is_valid_image:
+            return sheet_error(item, 'Invalid Image', 'INVALID_IMAGE', validation_message)
+
+        scores, total_score, answers = evaluate_omr_image(image, answer_key, label=item['filename'],
+                                                          return_answers=True)
+        if 'error' in scores:
+            return sheet_error(item, 'OMR Processing Failed', 'EVALUATION_ERROR',
+                               f"Could not evaluate the OMR sheet: {scores['error']}")
+
+        result.update({
+            'status': 'success',
+            'scores': scores,
+            'total_score': total_score,
+            'image_info': validation_message,
+            'answers': answers,
+        })
+        return result
+
+    except Exception as e:
+        logger.exception("Batch sheet %s failed", item.get('filename'))
+        return sheet_error(item, 'System Error', 'PROCESSING_ERROR', str(e))
+
+
+def parse_manifest(name, text, key='filename'):
+    """
+    Parse a batch manifest into {filename: {'student_id', 'version'}}.
+
+    CSV manifests need `filename` and `student_id` columns and may have a
+    `version` column; JSON manifests are a list of objects with the same
+    keys. Page rosters for multi-page scans pass key='page' and are
+    keyed by page number instead.
+    """
+    if name.lower().endswith('.json'):
+        rows = json.loads(text)
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+    manifest = {}
+    for row in rows:
+        filename = str(row.get(key) or '').strip()
+        if not filename:
+            continue
+        manifest[filename] = {
+            'student_id': (row.get('student_id') or '').strip() or None,
+            'version': (row.get('version') or '').strip() or None,
+        }
+    return manifest
+
+
+def iter_zip_items(stream, default_version=None):
+    """
+    Return an iterator of batch items from a ZIP archive holding images
+    plus a manifest.
+
+    The manifest is checked right away; image bytes are read one entry at
+    a time as the caller pulls items.
+    """
+    archive = zipfile.ZipFile(stream)
+    names = archive.namelist()
+
+    manifest_name = next((n for n in names if os.path.basename(n).lower() in MANIFEST_NAMES), None)
+    if manifest_name is None:
+        raise ValueError('ZIP archive must contain manifest.csv or manifest.json')
+    manifest = parse_manifest(manifest_name, archive.read(manifest_name).decode('utf-8-sig'))
+
+    image_names = [
+        n for n in names
+        if not n.endswith('/') and n != manifest_name
+        and file_extension(os.path.basename(n)) in IMAGE_EXTENSIONS
+    ]
+
+    def entries():
+        for index, name in enumerate(image_names):
+            filename = os.path.basename(name)
+            entry = manifest.get(name) or manifest.get(filename) or {}
+            yield {
+                'index': index,
+                'filename': filename,
+                'student_id': entry.get('student_id'),
+                'version': entry.get('version') or default_version,
+                'data': archive.read(name),
+            }
+
+    return entries()
+
+
+def check_item(item, answer_keys):
+    """Return an error result if `item` cannot be graded, else None."""
+    extensions = PAGED_EXTENSIONS if 'page' in item else IMAGE_EXTENSIONS
+    if file_extension(item.get('filename') or '') not in extensions:
+        return sheet_error(item, 'Invalid file type', 'FILE_TYPE_ERROR',
+                           f"Unsupported file '{item.get('filename')}'")
+    if not item.get('student_id'):
+        return sheet_error(item, 'Missing required information', 'VALIDATION_ERROR',
+                           'No student ID for this sheet')
+    if item.get('version') not in answer_keys:
+        return sheet_error(item, 'Invalid exam version', 'VALIDATION_ERROR',
+                           f'Version "{item.get("version")}" not found')
+    return None
+
+
+def _collect_finished(pending):
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        item = pending.pop(future)
+        try:
+            yield future.result()
+        except BrokenProcessPool:
+            _reset_pool()
+            yield sheet_error(item, 'System Error', 'PROCESSING_ERROR',
+                              'Grading worker crashed while processing this sheet')
+        except Exception as e:
+            yield sheet_error(item, 'System Error', 'PROCESSING_ERROR', str(e))
+
+
+def cached_result(item, cached):
+    """Build a success result for `item` from a result cache entry."""
+    result = {k: v for k, v in item.items() if k != 'data'}
+    result.update(cached, status='success', cache_hit=True)
+    return result
+
+
+def cache_value(result):
+    """The part of a success result that is kept in the result cache."""
+    return {k: result.get(k) for k in ('scores', 'total_score', 'image_info', 'answers')}
+
+
+def _store_finished(results, cache, cache_keys):
+    for result in results:
+        key = cache_keys.pop(result.get('index'), None)
+        if key is not None and result['status'] == 'success':
+            cache.put(key, cache_value(result))
+        yield result
+
+
+def iter_graded(items, answer_keys, max_in_flight=None, cache=None):
+    """
+    Grade batch items on the process pool and yield results as each
+    sheet finishes, in completion order.
+
+    At most `max_in_flight` sheets (default: twice the pool size) are
+    held in memory at once. Items that fail up-front checks, and sheets
+    whose worker fails, are yielded as error results; the batch keeps
+    going either way. With a ResultCache, sheets graded before are
+    answered from it without going to the pool.
+
+    Closing the generator early cancels the sheets not yet started and
+    returns once the running ones have finished.
+    """
+    max_in_flight = max_in_flight or 2 * pool_size()
+    pending = {}
+    cache_keys = {}
+    try:
+        for item in items:
+            rejected = check_item(item, answer_keys)
+            if rejected:
+                yield rejected
+                continue
+
+            # Pages of a multi-page scan have no bytes of their own to key on
+            if 'data' in item:
+                item['image_hash'] = image_digest(item['data'])
+            if cache is not None and 'data' in item:
+                with timed('cache_lookup'):
+                    key = cache_key(item['data'], answer_keys[item['version']], item['image_hash'])
+                    cached = cache.get(key)
+                if cached is not None:
+                    yield cached_result(item, cached)
+                    continue
+                cache_keys[item['index']] = key
+
+            while len(pending) >= max_in_flight:
+                yield from _store_finished(_collect_finished(pending), cache, cache_keys)
+
+            try:
+                future = get_pool().submit(grade_sheet_bytes, item, answer_keys[item['version']])
+            except BrokenProcessPool:
+                _reset_pool()
+                future = get_pool().submit(grade_sheet_bytes, item, answer_keys[item['version']])
+            pending[future] = {k: v for k, v in item.items() if k not in ('data', 'source')}
+
+        while pending:
+            yield from _store_finished(_collect_finished(pending), cache, cache_keys)
+    finally:
+        # Closed early (the client went away): drop sheets still queued and
+        # wait for the running ones, which may be reading the caller's files
+        for future in pending:
+            future.cancel()
+        wait(pending)
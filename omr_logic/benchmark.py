@@ -0,0 +1,265 @@
+"""
+End-to-end throughput and accuracy benchmark on a seeded synthetic corpus.
+
+    python -m omr_logic.benchmark --count 200 --workers 4 --out bench.json
+    python -m omr_logic.benchmark --baseline bench.json
+
+Each sheet is JPEG-encoded in memory and then decoded, validated and read
+exactly as an upload would be. The report gives sheets/sec, per-stage
+latency percentiles, peak RSS and answer accuracy (by mark kind) for a
+single-process run and a process-pool run.
+
+    python -m omr_logic.benchmark --mode decode --scale 4
+
+compares the full-resolution and reduced-resolution decode modes on the
+same corpus (--scale 4 renders phone-photo sized sheets, about 4000 px).
+--preset scanner renders sheets as a sheet-fed scanner would, all in
+nearly the same place, where outlines are mostly reused from the previous
+sheet (see 'outline_reused' in stage_ms). Outline reuse is on for the
+scanner preset only, unless --registration or --no-registration says
+otherwise; the report records which was used.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .buffers import get_buffer_pool
+from .evaluation import read_answers
+from .metrics import collect_spans, timed
+from .registration import enable_registration_cache
+from .runtime import init_pool_worker, init_scan_worker
+from .synthetic import DISTORTION_PRESETS, MARK_KINDS, generate_corpus
+from .utils import DECODE_MODES, decode_image
+from .validation import basic_image_validation
+
+PERCENTILES = (50, 90, 99)
+JPEG_QUALITY = 90
+
+
+def build_corpus(count, seed=0, layout_id=None, distortion=None):
+    """Return [(jpeg_bytes, truth)] for a seeded synthetic corpus."""
+    corpus = []
+    for _, image, truth in generate_corpus(count, seed, layout_id, distortion):
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            raise RuntimeError('Failed to encode a synthetic sheet')
+        corpus.append((encoded.tobytes(), truth))
+    return corpus
+
+
+def read_sheet(data, layout_id=None, decode_mode=None):
+    """
+    Decode, validate and read one encoded sheet.
+    Returns (detected answers or None, {stage: seconds}).
+    """
+    with collect_spans() as spans:
+        with timed('decode'):
+            image = decode_image(data, decode_mode, layout_id)
+        with timed('validation'):
+            is_valid, _ = basic_image_validation(image)
+        detected = None
+        if is_valid:
+            try:
+                detected, _, _ = read_answers(image, layout_id)
+            except ValueError:
+                pass
+    return detected, spans
+
+
+def _read_sheet_task(args):
+    return read_sheet(*args)
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _percentiles(values):
+    values = np.asarray(values) * 1000
+    return {f'p{p}': round(float(np.percentile(values, p)), 2) for p in PERCENTILES}
+
+
+def summarise(outputs, corpus, elapsed):
+    """Build one mode's report from its (detected, spans) outputs."""
+    stages = {}
+    for _, spans in outputs:
+        for stage, seconds in spans.items():
+            stages.setdefault(stage, []).append(seconds)
+    sheet_times = [sum(spans.values()) for _, spans in outputs]
+
+    correct = {name: 0 for name in MARK_KINDS.values()}
+    total = {name: 0 for name in MARK_KINDS.values()}
+    unread = 0
+    for (detected, _), (_, truth) in zip(outputs, corpus):
+        if detected is None:
+            unread += 1
+            continue
+        for code, name in MARK_KINDS.items():
+            mask = truth['kinds'] == code
+            total[name] += int(mask.sum())
+            correct[name] += int((detected[mask] == truth['answers'][mask]).sum())
+
+    questions = sum(total.values())
+    return {
+        'sheets': len(outputs),
+        'unread_sheets': unread,
+        'elapsed_s': round(elapsed, 3),
+        'sheets_per_s': round(len(outputs) / elapsed, 2) if elapsed else None,
+        'sheet_ms': _percentiles(sheet_times),
+        'stage_ms': {stage: _percentiles(values) for stage, values in sorted(stages.items())},
+        'accuracy': round(sum(correct.values()) / questions, 4) if questions else None,
+        'accuracy_by_kind': {name: round(correct[name] / total[name], 4)
+                             for name in total if total[name]},
+    }
+
+
+def run_single(corpus, layout_id=None, decode_mode=None):
+    start = time.perf_counter()
+    outputs = [read_sheet(data, layout_id, decode_mode) for data, _ in corpus]
+    report = summarise(outputs, corpus, time.perf_counter() - start)
+    report['peak_rss_mb'] = _peak_rss_mb()
+    report['buffer_pool'] = get_buffer_pool().stats()
+    return report
+
+
+def run_decode_comparison(corpus, layout_id=None):
+    """
+    Read the corpus once per decode mode, single-process. Adds each
+    mode's mean decoded image size, and the share of questions on which
+    the two modes read the same answer.
+    """
+    reports, detected = {}, {}
+    for mode in DECODE_MODES:
+        outputs = []
+        start = time.perf_counter()
+        for data, _ in corpus:
+            outputs.append(read_sheet(data, layout_id, mode))
+        reports[mode] = summarise(outputs, corpus, time.perf_counter() - start)
+        reports[mode]['decoded_mb'] = round(float(np.mean(
+            [decode_image(data, mode, layout_id).nbytes for data, _ in corpus])) / 2 ** 20, 2)
+        detected[mode] = [answers for answers, _ in outputs]
+
+    same = total = 0
+    for full, reduced in zip(*(detected[mode] for mode in DECODE_MODES)):
+        if full is not None and reduced is not None:
+            same += int((full == reduced).sum())
+            total += len(full)
+    reports['agreement'] = round(same / total, 4) if total else None
+    return reports
+
+
+def run_parallel(corpus, workers, layout_id=None, decode_mode=None, registration=False):
+    initializer = init_scan_worker if registration else init_pool_worker
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as pool:
+        # Start the workers before the clock, so startup is not counted
+        list(pool.map(int, range(workers)))
+        start = time.perf_counter()
+        outputs = list(pool.map(_read_sheet_task, [(data, layout_id, decode_mode) for data, _ in corpus],
+                                chunksize=max(1, len(corpus) // (workers * 8))))
+        elapsed = time.perf_counter() - start
+    report = summarise(outputs, corpus, elapsed)
+    report['workers'] = workers
+    report['peak_rss_mb'] = _peak_rss_mb()
+    report['peak_worker_rss_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return report
+
+
+def run_benchmark(count=100, seed=0, workers=None, layout_id=None, modes=('single', 'parallel'),
+                  decode_mode=None, scale=None, preset='photo', registration=None):
+    workers = workers or os.cpu_count() or 1
+    # Outline reuse only pays off when sheets sit in the same place, so by
+    # default it is measured on the scanner preset alone
+    if registration is None:
+        registration = preset == 'scanner'
+    if registration:
+        enable_registration_cache()
+    distortion = dict(DISTORTION_PRESETS[preset])
+    if scale:
+        distortion['scale'] = scale
+    corpus = build_corpus(count, seed, layout_id, distortion)
+    report = {
+        'corpus': {'count': count, 'seed': seed, 'layout_id': corpus[0][1]['layout_id'] if corpus else None,
+                   'preset': preset, 'scale': scale, 'mean_jpeg_kb': round(np.mean([len(d) for d, _ in corpus]) / 1024, 1)
+                   if corpus else 0},
+        'decode_mode': decode_mode,
+        'registration_cache': registration,
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+    }
+    if 'single' in modes:
+        report['single'] = run_single(corpus, layout_id, decode_mode)
+    if 'parallel' in modes:
+        report['parallel'] = run_parallel(corpus, workers, layout_id, decode_mode, registration)
+    if 'decode' in modes:
+        comparison = run_decode_comparison(corpus, layout_id)
+        report['decode_agreement'] = comparison.pop('agreement')
+        for mode, mode_report in comparison.items():
+            report[f'decode_{mode}'] = mode_report
+    return report
+
+
+def compare(report, baseline):
+    """Lines comparing the headline numbers of two reports."""
+    lines = []
+    for mode in ('single', 'parallel') + tuple(f'decode_{m}' for m in DECODE_MODES):
+        if mode not in report or mode not in baseline:
+            continue
+        for field in ('sheets_per_s', 'accuracy', 'peak_rss_mb'):
+            new, old = report[mode].get(field), baseline[mode].get(field)
+            if new is None or old is None:
+                continue
+            change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+            lines.append(f'{mode:8} {field:14} {old:>10} -> {new:<10} ({change})')
+        for stage, new in report[mode]['stage_ms'].items():
+            old = baseline[mode]['stage_ms'].get(stage)
+            if old:
+                lines.append(f"{mode:8} {stage + ' p50 ms':14} {old['p50']:>10} -> {new['p50']:<10}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OMR engine on synthetic sheets.')
+    parser.add_argument('--count', type=int, default=100, help='sheets in the corpus')
+    parser.add_argument('--seed', type=int, default=0, help='corpus seed')
+    parser.add_argument('--workers', type=int, default=None, help='process pool size (default: CPU count)')
+    parser.add_argument('--layout', default=None, help='sheet layout id (default: the configured default)')
+    parser.add_argument('--mode', choices=('single', 'parallel', 'both', 'decode'), default='both',
+                        help="'decode' compares the decode modes single-process")
+    parser.add_argument('--decode', choices=DECODE_MODES, help='decode mode (default: OMR_DECODE_MODE)')
+    parser.add_argument('--scale', type=float, help='rendered sheet size relative to the layout (default: 1.5)')
+    parser.add_argument('--preset', choices=sorted(DISTORTION_PRESETS), default='photo',
+                        help='photo: hand-held photos; scanner: sheet-fed scans in a fixed position')
+    parser.add_argument('--registration', action=argparse.BooleanOptionalAction,
+                        help='reuse sheet outlines between sheets (default: on for the scanner preset only)')
+    parser.add_argument('--out', help='write the JSON report here')
+    parser.add_argument('--baseline', help='compare against a previous JSON report')
+    args = parser.parse_args(argv)
+
+    modes = ('single', 'parallel') if args.mode == 'both' else (args.mode,)
+    report = run_benchmark(args.count, args.seed, args.workers, args.layout, modes, args.decode, args.scale, args.preset,
+                           args.registration)
+    print(json.dumps(report, indent=2))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get('corpus', {}).get('count'), baseline.get('corpus', {}).get('seed')) != \
+                (args.count, args.seed):
+            print('Warning: baseline was run on a different corpus', file=sys.stderr)
+        print('\n'.join(compare(report, baseline)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Reusable image buffers for the CV pipeline.
+
+Every sheet needs the same handful of intermediate images: the gray
+copy, the outline detection copy and its edges, the warped sheet, its
+ink mask and integral image, and the quality gate's thumbnail. Instead
+of allocating them per sheet, the pipeline leases them from a per-process
+BufferPool keyed by (shape, dtype) and has OpenCV write into them
+through `dst`. Once a worker has seen a sheet of a given size, further
+sheets of that size allocate no image memory and peak RSS stays flat.
+
+A lease hands its buffers back when it ends, so nothing leased may
+outlive it; results that are returned to callers are always fresh
+arrays (fills, corners, answers).
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from .metrics import Counter, Gauge
+
+BUFFER_POOL = os.environ.get('OMR_BUFFER_POOL', '1') != '0'
+
+# Idle buffers are kept up to this many bytes; the least recently used
+# shapes go first, so one-off photo sizes do not pin memory for good
+MAX_IDLE_BYTES = int(os.environ.get('OMR_BUFFER_POOL_MB', '64')) * 2 ** 20
+
+BUFFER_REQUESTS = Counter('omr_buffer_pool_requests_total',
+                          'Buffer pool requests, by result (hit: reused, miss: allocated).')
+
+
+class BufferPool:
+    """Per-process pool of idle arrays, keyed by (shape, dtype)."""
+
+    def __init__(self, max_idle_bytes=MAX_IDLE_BYTES):
+        self.max_idle_bytes = max_idle_bytes
+        self._idle = OrderedDict()  # (shape, dtype) -> [array, ...], least recently used first
+        self._idle_bytes = 0
+        self._leased_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, shape, dtype=np.uint8):
+        """Take an array of this shape and dtype; its contents are undefined."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        array = None
+        with self._lock:
+            free = self._idle.get(key)
+            if free:
+                array = free.pop()
+                self._idle_bytes -= array.nbytes
+                if not free:
+                    del self._idle[key]
+                self.hits += 1
+            else:
+                self.misses += 1
+        BUFFER_REQUESTS.inc(result='miss' if array is None else 'hit')
+        if array is None:
+            array = np.empty(shape, dtype=dtype)
+        with self._lock:
+            self._leased_bytes += array.nbytes
+        return array
+
+    def put(self, array):
+        """Give an array back for reuse. The caller must not touch it afterwards."""
+        key = (array.shape, array.dtype.str)
+        with self._lock:
+            self._leased_bytes -= array.nbytes
+            self._idle.setdefault(key, []).append(array)
+            self._idle.move_to_end(key)
+            self._idle_bytes += array.nbytes
+            while self._idle_bytes > self.max_idle_bytes and self._idle:
+                oldest, free = next(iter(self._idle.items()))
+                self._idle_bytes -= free.pop(0).nbytes
+                self.evictions += 1
+                if not free:
+                    del self._idle[oldest]
+
+    @contextmanager
+    def lease(self):
+        """Context manager yielding a Lease whose buffers are returned on exit."""
+        lease = Lease(self)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle_buffers': sum(len(free) for free in self._idle.values()),
+                'idle_bytes': self._idle_bytes,
+                'leased_bytes': self._leased_bytes,
+            }
+
+
+class Lease:
+    """Buffers taken from a pool for one sheet; see BufferPool.lease()."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._taken = []
+
+    def get(self, shape, dtype=np.uint8):
+        array = self.pool.get(shape, dtype)
+        self._taken.append(array)
+        return array
+
+    def release(self):
+        while self._taken:
+            self.pool.put(self._taken.pop())
+
+
+class _NoPool:
+    """Stand-in when OMR_BUFFER_POOL=0: every buffer is a fresh array."""
+
+    @contextmanager
+    def lease(self):
+        yield self
+
+    @staticmethod
+    def get(shape, dtype=np.uint8):
+        return np.empty(shape, dtype=dtype)
+
+    @staticmethod
+    def stats():
+        return {}
+
+
+_pool = BufferPool() if BUFFER_POOL else _NoPool()
+
+
+def get_buffer_pool():
+    """The process-wide pool (a pass-through when OMR_BUFFER_POOL=0)."""
+    return _pool
+
+
+BUFFER_POOL_BYTES = Gauge('omr_buffer_pool_bytes', 'Image buffer pool memory, by state (idle or leased).',
+                          fn=lambda: {state: get_buffer_pool().stats().get(f'{state}_bytes', 0)
+                                      for state in ('idle', 'leased')},
+                          label='state')
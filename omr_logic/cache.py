@@ -0,0 +1,138 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from .db import DB_PATH, get_connection
+from .layout import load_layouts
+from .metrics import Counter
+from .utils import DECODE_MODE
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever a code change alters the scores a given image produces,
+# so results cached by the old pipeline are no longer found
+PIPELINE_VERSION = 2
+
+# Rows the result_cache table keeps; the oldest-written beyond this are
+# pruned every PRUNE_INTERVAL writes
+MAX_STORED_ENTRIES = int(os.environ.get('OMR_RESULT_CACHE_ROWS', '100000'))
+PRUNE_INTERVAL = 256
+
+CACHE_LOOKUPS = Counter('omr_result_cache_lookups_total',
+                        'Result cache lookups, by the tier that answered (memory, sqlite or miss).')
+
+
+@lru_cache(maxsize=None)
+def layout_signature(layout_id):
+    """Short hash of a layout's definition, so editing the geometry invalidates cached results."""
+    _, layouts = load_layouts()
+    definition = json.dumps(layouts[layout_id], sort_keys=True)
+    return hashlib.sha1(definition.encode()).hexdigest()[:16]
+
+
+def image_digest(data):
+    """SHA-256 of an upload's bytes; also stored with its results row to spot resubmissions."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(data, answer_key, digest=None):
+    """
+    Key a sheet's result by the SHA-256 of its image bytes, the exam
+    version, the compiled answer key's fingerprint, the layout it was
+    compiled against and the decode mode. Any change to these yields new
+    keys, so stale entries are simply never looked up again. Pass
+    `digest` if image_digest(data) is already known.
+    """
+    digest = digest or image_digest(data)
+    return ':'.join((
+        digest,
+        str(answer_key.version),
+        answer_key.fingerprint,
+        layout_signature(answer_key.layout_id),
+        str(PIPELINE_VERSION),
+        DECODE_MODE,
+    ))
+
+
+class ResultCache:
+    """
+    Two-tier cache of successful grading results.
+
+    An in-process LRU holds the most recent `max_entries` results; behind
+    it, the result_cache table keeps them across restarts and shares them
+    between workers. Values are small JSON-serialisable dicts (scores,
+    total_score, image_info). Pass `path=None` for a memory-only cache.
+    """
+
+    def __init__(self, path=DB_PATH, max_entries=1024, max_stored=MAX_STORED_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_stored = max_stored
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = itertools.count(1)
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        if value is not None:
+            CACHE_LOOKUPS.inc(tier='memory')
+            return value
+
+        if self.path is not None:
+            try:
+                row = get_connection(self.path).execute(
+                    'SELECT value FROM result_cache WHERE key = ?', (key,)
+                ).fetchone()
+            except Exception:
+                logger.exception("Result cache lookup failed")
+                row = None
+            if row is not None:
+                value = json.loads(row['value'])
+                self._remember(key, value)
+                CACHE_LOOKUPS.inc(tier='sqlite')
+                return value
+
+        CACHE_LOOKUPS.inc(tier='miss')
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.path is None:
+            return
+        # A failed write only costs a future miss, so never fail the request over it
+        try:
+            conn = get_connection(self.path)
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO result_cache (key, value) VALUES (?, ?)',
+                             (key, json.dumps(value)))
+                if next(self._writes) % PRUNE_INTERVAL == 0:
+                    self._prune(conn)
+        except Exception:
+            logger.exception("Result cache write failed")
+
+    def _prune(self, conn):
+        """Drop the oldest-written rows beyond max_stored."""
+        conn.execute('''
+            DELETE FROM result_cache WHERE key IN (
+                SELECT key FROM result_cache ORDER BY created_at
+                LIMIT MAX((SELECT COUNT(*) FROM result_cache) - ?, 0)
+            )
+        ''', (self.max_stored,))
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,570 @@
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from .items import pack_answers, rebuild_item_stats, update_item_stats
+from .metrics import Counter, Gauge, Histogram, timed
+
+DB_PATH = os.environ.get('OMR_DB_PATH', 'results.db')
+
+logger = logging.getLogger(__name__)
+
+RESULT_COLUMNS = (
+    'student_id', 'sheet_version',
+    'subject1_score', 'subject2_score', 'subject3_score', 'subject4_score', 'subject5_score',
+    'total_score',
+)
+
+# Stored alongside the scores but not part of query results: the sheet
+# layout, the answers read from it (packed by omr_logic.items) and the
+# SHA-256 of the uploaded image
+RESULT_DETAIL_COLUMNS = ('layout_id', 'answers', 'image_hash')
+
+_local = threading.local()
+
+
+def connect(path=DB_PATH):
+    """
+    Open a connection in WAL mode, so readers never block the writer and
+    a commit appends to the log instead of rewriting the database file.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection(path=DB_PATH):
+    """
+    Return this thread's reusable connection to `path`. Connections are
+    never shared across threads or carried over a fork.
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None or _local.pid != os.getpid():
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = connect(path)
+    return conn
+
+
+SCORE_COLUMNS = RESULT_COLUMNS[2:]
+
+RESULT_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_results_student ON results (student_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_results_version ON results (sheet_version, id)',
+    'CREATE INDEX IF NOT EXISTS idx_results_timestamp ON results (timestamp, id)',
+    # The same image submitted again for the same student and version is
+    # one result, however often it is retried or answered from the cache
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_results_submission '
+    'ON results (image_hash, student_id, sheet_version) WHERE image_hash IS NOT NULL',
+)
+
+
+def _stats_delta_sql(row, sign):
+    """
+    Upserts that add (sign '+') or remove (sign '-') one results row,
+    `row` being NEW or OLD, from the per-version aggregates.
+    """
+    sums = ', '.join(f'{c}_sum, {c}_sumsq' for c in SCORE_COLUMNS)
+    values = ', '.join(
+        f'{sign}COALESCE({row}.{c}, 0), {sign}COALESCE({row}.{c}, 0) * COALESCE({row}.{c}, 0)'
+        for c in SCORE_COLUMNS
+    )
+    updates = ', '.join(
+        f'{c}_sum = {c}_sum + excluded.{c}_sum, {c}_sumsq = {c}_sumsq + excluded.{c}_sumsq'
+        for c in SCORE_COLUMNS
+    )
+    return f'''
+        INSERT INTO version_stats (sheet_version, n, {sums})
+        VALUES ({row}.sheet_version, {sign}1, {values})
+        ON CONFLICT (sheet_version) DO UPDATE SET n = n + excluded.n, {updates};
+        INSERT INTO score_histogram (sheet_version, total_score, count)
+        VALUES ({row}.sheet_version, COALESCE({row}.total_score, 0), {sign}1)
+        ON CONFLICT (sheet_version, total_score) DO UPDATE SET count = count + excluded.count;
+    '''
+
+
+def _create_aggregates(conn):
+    """
+    Create the per-version aggregate tables and the triggers that keep
+    them in step with `results`. Returns True if the tables are new and
+    need to be backfilled from existing rows.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'version_stats'"
+    ).fetchone()
+
+    sums = ', '.join(f'{c}_sum INTEGER NOT NULL DEFAULT 0, {c}_sumsq INTEGER NOT NULL DEFAULT 0'
+                     for c in SCORE_COLUMNS)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS version_stats (
+            sheet_version TEXT PRIMARY KEY,
+            n INTEGER NOT NULL DEFAULT 0,
+            {sums}
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS score_histogram (
+            sheet_version TEXT NOT NULL,
+            total_score INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (sheet_version, total_score)
+        ) WITHOUT ROWID
+    ''')
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS results_stats_insert AFTER INSERT ON results
+        BEGIN {_stats_delta_sql('NEW', '+')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS results_stats_delete AFTER DELETE ON results
+        BEGIN {_stats_delta_sql('OLD', '-')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS results_stats_update
+        AFTER UPDATE OF sheet_version, {', '.join(SCORE_COLUMNS)} ON results
+        BEGIN {_stats_delta_sql('OLD', '-')} {_stats_delta_sql('NEW', '+')} END
+    ''')
+    return not exists
+
+
+def rebuild_aggregates(conn):
+    """Recompute the aggregate tables from a full scan of `results`."""
+    sums = ', '.join(f'{c}_sum, {c}_sumsq' for c in SCORE_COLUMNS)
+    totals = ', '.join(f'COALESCE(SUM({c}), 0), COALESCE(SUM({c} * {c}), 0)' for c in SCORE_COLUMNS)
+    conn.execute('DELETE FROM version_stats')
+    conn.execute('DELETE FROM score_histogram')
+    conn.execute(f'''
+        INSERT INTO version_stats (sheet_version, n, {sums})
+        SELECT sheet_version, COUNT(*), {totals} FROM results GROUP BY sheet_version
+    ''')
+    conn.execute('''
+        INSERT INTO score_histogram (sheet_version, total_score, count)
+        SELECT sheet_version, COALESCE(total_score, 0), COUNT(*) FROM results
+        GROUP BY sheet_version, COALESCE(total_score, 0)
+    ''')
+
+
+def _add_columns(conn, table, columns):
+    """Add any of `columns` ((name, declaration) pairs) that `table` lacks."""
+    existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for name, declaration in columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {declaration}')
+
+
+def _create_item_stats(conn):
+    """
+    Create the per-question counters (see omr_logic.items). Returns True
+    if the table is new and needs to be backfilled from stored answers.
+    """
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(item_stats)')}
+    # Counters from before they were kept per layout cannot be split up; recount them
+    if columns and 'layout_id' not in columns:
+        conn.execute('DROP TABLE item_stats')
+        columns = set()
+    # option is the chosen option's index, -1 for blank
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS item_stats (
+            sheet_version TEXT NOT NULL,
+            layout_id TEXT NOT NULL,
+            question INTEGER NOT NULL,
+            option INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            score_sum INTEGER NOT NULL,
+            score_sumsq INTEGER NOT NULL,
+            PRIMARY KEY (sheet_version, layout_id, question, option)
+        ) WITHOUT ROWID
+    ''')
+    return not columns
+
+
+def init_db(path=DB_PATH):
+    conn = connect(path)
+    # One write transaction, so workers starting together do not race
+    # on creating the triggers and backfilling the aggregates
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT NOT NULL,
+                sheet_version TEXT NOT NULL,
+                subject1_score INTEGER,
+                subject2_score INTEGER,
+                subject3_score INTEGER,
+                subject4_score INTEGER,
+                subject5_score INTEGER,
+                total_score INTEGER,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                layout_id TEXT,
+                answers BLOB,
+                image_hash TEXT
+            );
+        ''')
+        # Databases created before these columns existed
+        _add_columns(conn, 'results', [('layout_id', 'TEXT'), ('answers', 'BLOB'), ('image_hash', 'TEXT')])
+        for statement in RESULT_INDEXES:
+            conn.execute(statement)
+        # Grading job queue (see omr_logic.jobs)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'queued',
+                student_id TEXT NOT NULL,
+                sheet_version TEXT NOT NULL,
+                filename TEXT,
+                payload BLOB,
+                result TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+        # Persistent tier of the result cache (see omr_logic.cache)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_result_cache_created ON result_cache (created_at)')
+        if _create_aggregates(conn):
+            rebuild_aggregates(conn)
+        if _create_item_stats(conn):
+            rebuild_item_stats(conn)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def result_row(student_id, version, answer_key, scores, total_score, answers=None, image_hash=None):
+    """
+    Build a results row. Subject scores go into the generic subjectN
+    columns in the sheet layout's subject order, padded to five.
+    `answers` are the detected answers (-1 for blank), stored packed;
+    rows without them are left out of the item statistics. Rows with an
+    `image_hash` are stored once per image, student and version (see
+    insert_results).
+    """
+    subject_names = list(answer_key.subjects)[:5]
+    subject_scores = [scores.get(name) for name in subject_names]
+    subject_scores += [None] * (5 - len(subject_scores))
+
+    row = {
+        'student_id': student_id,
+        'sheet_version': version,
+        'total_score': total_score,
+        'layout_id': answer_key.layout_id,
+        'answers': pack_answers(answers) if answers is not None else None,
+        'image_hash': image_hash,
+    }
+    for i, score in enumerate(subject_scores, start=1):
+        row[f'subject{i}_score'] = score
+    return row
+
+
+def insert_results(conn, rows):
+    """
+    Insert result rows (dicts keyed by RESULT_COLUMNS, plus optionally
+    RESULT_DETAIL_COLUMNS) and add their answers to the item_stats
+    counters, without committing.
+
+    A resubmission of an image already stored for the same student and
+    version updates that row instead, if it was graded differently (the
+    answer key or pipeline changed in between); the aggregates and
+    item_stats move from the old scores to the new ones. An identical
+    resubmission is skipped. Returns the number of rows inserted or
+    updated.
+    """
+    columns = RESULT_COLUMNS + RESULT_DETAIL_COLUMNS
+    refreshed = [c for c in columns if c not in ('student_id', 'sheet_version', 'image_hash')]
+    sql = (
+        f"INSERT INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        "ON CONFLICT (image_hash, student_id, sheet_version) WHERE image_hash IS NOT NULL DO UPDATE SET "
+        + ', '.join(f'{c} = excluded.{c}' for c in refreshed) + ', timestamp = CURRENT_TIMESTAMP '
+        'WHERE ' + ' OR '.join(f'{c} IS NOT excluded.{c}' for c in refreshed)
+    )
+    stored, replaced = [], []
+    for row in rows:
+        previous = None
+        if row.get('image_hash') is not None:
+            previous = conn.execute(
+                'SELECT sheet_version, layout_id, answers, total_score FROM results '
+                'WHERE image_hash = ? AND student_id = ? AND sheet_version = ?',
+                (row['image_hash'], row.get('student_id'), row.get('sheet_version'))
+            ).fetchone()
+        if conn.execute(sql, tuple(row.get(c) for c in columns)).rowcount:
+            stored.append(row)
+            if previous is not None:
+                replaced.append(dict(previous))
+    # The score triggers handle the aggregates; item_stats follow like a regrade
+    update_item_stats(conn, replaced, sign=-1)
+    update_item_stats(conn, stored)
+    return len(stored)
+
+
+def query_results(conn, student_id=None, version=None, since=None, until=None,
+                  before_id=None, limit=50):
+    """
+    Return one page of results, newest first, and the cursor for the next
+    page (None on the last page).
+
+    Pages are keyed on `id` rather than OFFSET, so each page is a range
+    scan over the matching index however deep the caller has paged.
+    `since` and `until` compare against the stored timestamp text
+    ('YYYY-MM-DD HH:MM:SS', UTC).
+    """
+    clauses, params = [], []
+    if student_id is not None:
+        clauses.append('student_id = ?')
+        params.append(student_id)
+    if version is not None:
+        clauses.append('sheet_version = ?')
+        params.append(version)
+    if since is not None:
+        clauses.append('timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append('timestamp < ?')
+        params.append(until)
+    if before_id is not None:
+        clauses.append('id < ?')
+        params.append(before_id)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    rows = conn.execute(
+        f"SELECT id, {', '.join(RESULT_COLUMNS)}, timestamp FROM results {where} "
+        f"ORDER BY id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return [dict(row) for row in rows[:limit]], next_cursor
+
+
+def _mean_std(total, total_sq, n):
+    mean = total / n
+    variance = max(total_sq / n - mean * mean, 0.0)
+    return round(mean, 3), round(variance ** 0.5, 3)
+
+
+def version_stats(conn, version):
+    """
+    Return the aggregate scores for one sheet version from the
+    trigger-maintained tables, or None if nothing has been graded:
+    {'count', 'total': (mean, std), 'columns': {column: (mean, std)},
+    'histogram': {total_score: count}}.
+    """
+    row = conn.execute('SELECT * FROM version_stats WHERE sheet_version = ?', (version,)).fetchone()
+    if row is None or row['n'] <= 0:
+        return None
+
+    n = row['n']
+    columns = {c: _mean_std(row[f'{c}_sum'], row[f'{c}_sumsq'], n) for c in SCORE_COLUMNS}
+    histogram = conn.execute(
+        'SELECT total_score, count FROM score_histogram '
+        'WHERE sheet_version = ? AND count > 0 ORDER BY total_score',
+        (version,)
+    ).fetchall()
+
+    return {
+        'count': n,
+        'total': columns.pop('total_score'),
+        'columns': columns,
+        'histogram': {score: count for score, count in histogram},
+    }
+
+
+# How long a request thread waits for room in a full write queue before
+# giving up on storing its row
+QUEUE_TIMEOUT = 5
+
+WRITE_QUEUE_DEPTH = Gauge('omr_db_write_queue_depth', 'Result rows waiting in the write-behind queue.')
+ROWS_WRITTEN = Counter('omr_db_rows_written_total', 'Result rows committed, by outcome.')
+COMMIT_FAILURES = Counter('omr_db_commit_failures_total',
+                          'Group commits that failed, losing their rows, by error type.')
+COMMIT_BATCH_SIZE = Histogram('omr_db_commit_batch_rows', 'Rows per group commit.',
+                              buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+
+class WriteQueueFull(Exception):
+    """Raised when a row cannot be queued: the writer is not keeping up."""
+
+
+class PendingWrite:
+    """Handle for a queued row; `wait` blocks until its batch commits."""
+
+    def __init__(self, row):
+        self.row = row
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError('Timed out waiting for the result to be committed')
+        if self.error is not None:
+            raise self.error
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+
+class ResultWriter:
+    """
+    Write-behind queue for result rows.
+
+    Rows are queued by request threads and committed by one background
+    thread in batches of up to `max_batch` rows, or whatever has arrived
+    `max_delay` seconds after the first row of a batch. That turns one
+    fsync per sheet into one per batch. The queue is bounded, so a stalled
+    database pushes back on callers instead of growing without limit.
+
+    A batch whose commit fails is rolled back and its rows are lost:
+    callers waiting on them get the error, the rest only see it in the
+    log and in omr_db_commit_failures_total.
+    """
+
+    def __init__(self, path=DB_PATH, max_batch=200, max_delay=0.25, max_queue=5000):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='omr-result-writer', daemon=True)
+        self._thread.start()
+
+    def _put(self, item, timeout):
+        try:
+            self._queue.put(item, timeout=timeout)
+        except queue.Full:
+            raise WriteQueueFull(f'Result write queue still full after {timeout}s') from None
+        WRITE_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def submit(self, row, wait=False, timeout=30, queue_timeout=QUEUE_TIMEOUT):
+        """
+        Queue one result row. With `wait=True`, block until the row is
+        committed (read-after-write) and re-raise any database error.
+
+        Raises WriteQueueFull if the queue stays full for `queue_timeout`
+        seconds (None waits as long as it takes); the row is then not
+        stored.
+        """
+        if self._closed:
+            raise RuntimeError('Result writer is closed')
+        pending = PendingWrite(row)
+        self._put(pending, queue_timeout)
+        if wait:
+            pending.wait(timeout)
+        return pending
+
+    def flush(self, timeout=30):
+        """Block until everything queued so far has been committed."""
+        marker = PendingWrite(None)
+        self._put(marker, timeout)
+        marker.wait(timeout)
+
+    def close(self, timeout=30):
+        """Flush outstanding rows and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        """Return (batch, stop): the next group of queued writes, and
+        whether close() was requested."""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, conn, batch):
+        rows = [p.row for p in batch if p.row is not None]
+        error = None
+        if rows:
+            try:
+                with timed('db_commit'):
+                    with conn:
+                        stored = insert_results(conn, rows)
+                ROWS_WRITTEN.inc(stored, outcome='committed')
+                if stored < len(rows):
+                    ROWS_WRITTEN.inc(len(rows) - stored, outcome='duplicate')
+                COMMIT_BATCH_SIZE.observe(len(rows))
+            except Exception as e:
+                logger.exception("Failed to commit %d result rows", len(rows))
+                ROWS_WRITTEN.inc(len(rows), outcome='failed')
+                COMMIT_FAILURES.inc(error=type(e).__name__)
+                error = e
+        for pending in batch:
+            pending._finish(error if pending.row is not None else None)
+
+    def _run(self):
+        conn = connect(self.path)
+        # Every batch is a single transaction; make its commit durable
+        conn.execute('PRAGMA synchronous=FULL')
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._next_batch()
+                self._commit(conn, batch)
+                WRITE_QUEUE_DEPTH.set(self._queue.qsize())
+        finally:
+            conn.close()
+
+
+_writers = {}
+_writers_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer(path=DB_PATH):
+    """
+    Return this process's result writer for `path`, starting it on first
+    use. Writers are recreated after a fork, since threads do not survive
+    one.
+    """
+    global _writers, _writers_pid
+    writer = _writers.get(path) if _writers_pid == os.getpid() else None
+    if writer is None:
+        with _writer_lock:
+            if _writers_pid != os.getpid():
+                _writers, _writers_pid = {}, os.getpid()
+            writer = _writers.get(path)
+            if writer is None:
+                writer = _writers[path] = ResultWriter(path)
+                atexit.register(writer.close)
+    return writer
@@ -0,0 +1,267 @@
+"""
+Single-sheet grading engine: everything /api/upload does between
+receiving the bytes and replying.
+
+A GradingEngine holds what grading needs across sheets: the answer key
+registry, the result cache and the results database (initialised once,
+written through the write-behind writer). The Flask route and the
+Streamlit app's embedded mode both grade through GradingEngine.grade(),
+so a sheet is validated, cached and stored the same way whether it
+arrived over HTTP or in-process.
+"""
+import logging
+import os
+
+from werkzeug.utils import secure_filename
+
+from .answer_keys import AnswerKeyRegistry
+from .cache import ResultCache, cache_key, image_digest
+from .db import DB_PATH, QUEUE_TIMEOUT, WriteQueueFull, get_writer, init_db, result_row
+from .evaluation import evaluate_omr_image, evaluate_omr_sheet
+from .metrics import SHEETS_TOTAL, timed
+from .utils import decode_image
+from .validation import basic_image_validation
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'tiff', 'gif'}
+
+
+def validate_filename(filename):
+    """Return (ok, message) for an uploaded file's name."""
+    if not filename:
+        return False, "Empty filename"
+    file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
+    if file_ext not in UPLOAD_EXTENSIONS:
+        return False, f"Invalid file type '{file_ext}'. Allowed formats: JPG, JPEG, PNG, BMP, TIFF"
+    return True, "Valid file type"
+
+
+def score_warnings(total_score):
+    warnings = []
+    if total_score == 0:
+        warnings.append("No correct answers detected - please verify the answer key or bubble filling")
+    elif total_score < 5:
+        warnings.append("Very low score detected - please check if bubbles are properly filled")
+    return warnings
+
+
+class GradingEngine:
+    """
+    Grades single uploaded sheets against the registered answer keys and
+    stores the results. Safe to share between threads.
+
+    `save_uploads` is a directory to write each upload to and evaluate
+    it from disk instead of decoding in memory (debugging only).
+    """
+
+    def __init__(self, db_path=DB_PATH, answer_keys=None, result_cache=True, cache_size=1024,
+                 save_uploads=None):
+        init_db(db_path)
+        self.db_path = db_path
+        self.answer_keys = answer_keys if answer_keys is not None else AnswerKeyRegistry()
+        self.result_cache = ResultCache(db_path, max_entries=cache_size) if result_cache else None
+        self.save_uploads = save_uploads
+        if save_uploads:
+            os.makedirs(save_uploads, exist_ok=True)
+
+    def save_result(self, student_id, version, answer_key, scores, total_score, answers=None, image_hash=None,
+                    wait=False):
+        """
+        Queue a result row on the write-behind writer. With `wait=True` this
+        returns only once the row is committed. A resubmitted image (same
+        `image_hash`, student and version) is not stored again.
+        """
+        row = result_row(student_id, version, answer_key, scores, total_score, answers, image_hash)
+        with timed('db_insert'):
+            get_writer(self.db_path).submit(row, wait=wait)
+
+    def _success(self, student_id, version, answer_key, scores, total_score, validation_message,
+                 answers=None, image_hash=None, cache_hit=False, sync=False, route='upload'):
+        """
+        Record a graded sheet and build the success response: 200, or 202
+        when a `sync` wait for the commit timed out. The row is then still
+        queued and normally commits shortly; resending the sheet does not
+        store it twice. If the write queue is full the row is not stored,
+        and the response is a 503 to retry.
+        """
+        status = 200
+        try:
+            self.save_result(student_id, version, answer_key, scores, total_score, answers, image_hash, wait=sync)
+        except TimeoutError:
+            logger.warning("Result for student %s, version %s not committed yet; answering 202",
+                           student_id, version)
+            status = 202
+        except WriteQueueFull as e:
+            logger.error("Result for student %s, version %s not stored: %s", student_id, version, e)
+            SHEETS_TOTAL.inc(route=route, outcome='storage_busy')
+            return {
+                'error': 'Server busy',
+                'error_type': 'STORAGE_BUSY',
+                'details': 'The sheet was graded but the result could not be stored; the database is not '
+                           'keeping up',
+                'student_id': student_id,
+                'version': version,
+                'retry_after': QUEUE_TIMEOUT,
+                'suggestions': ['Wait a few seconds and upload the sheet again'],
+            }, 503
+
+        response_data = {
+            'student_id': student_id,
+            'version': version,
+            'scores': scores,
+            'total_score': total_score,
+            'max_possible_score': answer_key.max_score,
+            'evaluation_status': 'success',
+            'image_info': validation_message
+        }
+        if cache_hit:
+            response_data['cache_hit'] = True
+        if status == 202:
+            response_data['storage'] = 'pending'
+
+        warnings = score_warnings(total_score)
+        if warnings:
+            response_data['warnings'] = warnings
+
+        logger.info("Graded %s for student %s, version %s: %s/%s",
+                    'cached sheet' if cache_hit else 'sheet', student_id, version,
+                    total_score, answer_key.max_score)
+        SHEETS_TOTAL.inc(route=route, outcome='success')
+        return response_data, status
+
+    def grade(self, data, filename, student_id, version, sync=False, route='upload'):
+        """
+        Validate, grade and store one uploaded sheet. Returns (response
+        body, HTTP status), the body being what /api/upload replies with.
+        With `sync`, returns only once the result row is committed.
+
+        `filename` is the name as uploaded: its extension is checked as
+        is, and only a sanitised copy is used for paths and log labels.
+        """
+        filepath = None
+        label = secure_filename(filename or '') or 'upload'
+        try:
+            is_valid_type, type_message = validate_filename(filename)
+            if not is_valid_type:
+                return {
+                    'error': 'Invalid file type',
+                    'error_type': 'FILE_TYPE_ERROR',
+                    'details': type_message,
+                    'suggestions': [
+                        'Upload a valid image file (JPG, PNG, BMP, TIFF)',
+                        'Ensure the file extension is correct'
+                    ]
+                }, 400
+
+            if not student_id or not version:
+                return {
+                    'error': 'Missing required information',
+                    'error_type': 'VALIDATION_ERROR',
+                    'details': 'Both student ID and version are required'
+                }, 400
+
+            # Take one key snapshot for the whole sheet, even if the file reloads meanwhile
+            answer_key = self.answer_keys.get(version)
+            if answer_key is None:
+                return {
+                    'error': 'Invalid exam version',
+                    'error_type': 'VALIDATION_ERROR',
+                    'details': f'Version "{version}" not found'
+                }, 400
+
+            digest = image_digest(data)
+            key = None
+            if self.result_cache is not None:
+                with timed('cache_lookup'):
+                    key = cache_key(data, answer_key, digest)
+                    cached = self.result_cache.get(key)
+                if cached is not None:
+                    return self._success(student_id, version, answer_key, cached['scores'],
+                                         cached['total_score'], cached['image_info'], cached.get('answers'),
+                                         digest, cache_hit=True, sync=sync, route=route)
+
+            if self.save_uploads:
+                filepath = os.path.join(self.save_uploads, label)
+                with open(filepath, 'wb') as f:
+                    f.write(data)
+                logger.info("Saved upload to %s", filepath)
+                image = None
+            else:
+                # Decode once; validation and evaluation share the same array
+                with timed('decode'):
+                    image = decode_image(data, layout_id=answer_key.layout_id)
+
+            with timed('validation'):
+                is_valid_image, validation_message = basic_image_validation(filepath or image)
+
+            if not is_valid_image:
+                SHEETS_TOTAL.inc(route=route, outcome='invalid_image')
+                return {
+                    'error': 'Invalid Image',
+                    'error_type': 'INVALID_IMAGE',
+                    'details': validation_message,
+                    'student_id': student_id,
+                    'version': version,
+                    'suggestions': [
+                        'Please upload a clear, readable image',
+                        'Ensure the image is not corrupted',
+                        'Try taking a new photo with better quality',
+                        'Make sure the image file is valid'
+                    ]
+                }, 400
+
+            try:
+                if filepath:
+                    scores, total_score, answers = evaluate_omr_sheet(filepath, answer_key, return_answers=True)
+                else:
+                    scores, total_score, answers = evaluate_omr_image(image, answer_key, label=label,
+                                                                      return_answers=True)
+                if 'error' in scores:
+                    raise ValueError(scores['error'])
+
+            except Exception as eval_error:
+                logger.exception("Evaluation failed for student %s, version %s", student_id, version)
+                SHEETS_TOTAL.inc(route=route, outcome='evaluation_error')
+                return {
+                    'error': 'OMR Processing Failed',
+                    'error_type': 'EVALUATION_ERROR',
+                    'details': f'Could not evaluate the OMR sheet: {str(eval_error)}',
+                    'student_id': student_id,
+                    'version': version,
+                    'suggestions': [
+                        'Make sure the image shows a complete OMR sheet',
+                        'Ensure bubbles are clearly visible and properly filled',
+                        'Check that the image is not rotated or skewed',
+                        'Try uploading a clearer image of the OMR sheet',
+                        'Verify that the sheet contains the expected bubble pattern'
+                    ]
+                }, 500
+
+            if key is not None:
+                self.result_cache.put(key, {'scores': scores, 'total_score': total_score,
+                                            'image_info': validation_message, 'answers': answers})
+
+            return self._success(student_id, version, answer_key, scores, total_score, validation_message,
+                                 answers, digest, sync=sync, route=route)
+
+        except Exception as e:
+            logger.exception("Unexpected error grading %s", label)
+            SHEETS_TOTAL.inc(route=route, outcome='system_error')
+            return {
+                'error': 'System Error',
+                'error_type': 'PROCESSING_ERROR',
+                'details': str(e),
+                'suggestions': [
+                    'Try uploading the image again',
+                    'Ensure the image file is not corrupted',
+                    'Contact support if the problem persists'
+                ]
+            }, 500
+
+        finally:
+            if filepath and os.path.exists(filepath):
+                try:
+                    os.remove(filepath)
+                except OSError as cleanup_error:
+                    logger.warning("Failed to clean up %s: %s", filepath, cleanup_error)
@@ -1,146 +1,138 @@
+import logging
+import time
 import cv2
 import numpy as np
+from .buffers import get_buffer_pool
+from .metrics import observe_stage, timed
+from .registration import get_registration_cache
 from .utils import get_sheet_outline, get_warped_image
+from .scoring import threshold_sheet, compute_fill_matrix, pick_answers
+from .layout import compile_layout
+from .answer_keys import CompiledKey, compile_answer_key, grade_answers
 
-# Assuming detect_bubbles is a function that processes a small ROI
-# and returns a list of pixel intensities for each bubble option.
-# You will need to define this in your utils.py or here.
-def detect_bubbles(roi):
-    # This is a placeholder function. You need to implement your
-    # actual bubble detection logic here.
-    # For now, it will apply a threshold and count filled pixels.
-    
-    gray_roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-    _, thresh_roi = cv2.threshold(gray_roi, 180, 255, cv2.THRESH_BINARY_INV)
-    
-    intensities = []
-    # Assuming 4 options (A, B, C, D)
-    for opt in range(4):
-        opt_width = thresh_roi.shape[1] // 4
-        opt_roi = thresh_roi[:, opt * opt_width: (opt + 1) * opt_width]
-        intensities.append(np.sum(opt_roi) / 255)
-        
-    return intensities
-
-def generate_bubble_coordinates(sheet_width=800, sheet_height=1000):
+logger = logging.getLogger(__name__)
+
+def generate_bubble_coordinates(sheet_width=800, sheet_height=1000, layout_id=None):
+    """
+    Generate bubble coordinates for an OMR sheet layout from subject_config.json.
+    Kept for callers that want one dict per question; the evaluator uses the
+    compiled layout arrays directly.
+    """
+    layout = compile_layout(layout_id, sheet_width, sheet_height)
+    return [
+        {'x': int(x), 'y': int(y), 'width': int(w), 'height': int(h)}
+        for x, y, w, h in layout.boxes
+    ]
+
+def evaluate_omr_sheet(image_path, answer_key, layout_id=None, return_answers=False):
+    """
+    Evaluates a single OMR sheet image file using a dictionary-based answer key.
+    """
+    image = cv2.imread(image_path)
+    if image is None:
+        logger.error("Could not load image from %s", image_path)
+        error = {'error': f"Could not load image from {image_path}"}
+        return (error, 0, None) if return_answers else (error, 0)
+
+    return evaluate_omr_image(image, answer_key, label=image_path, layout_id=layout_id,
+                              return_answers=return_answers)
+
+def read_answers(image, layout_id=None, interpolation=cv2.INTER_LINEAR):
     """
-    Generate bubble coordinates for a standard OMR sheet layout.
-    Adjust these values based on your actual OMR sheet layout.
+    Locate and warp the sheet, then read every question on the layout.
+
+    The sheet is warped in grayscale straight to the layout's canonical
+    sheet_size, so the compiled bubble geometry is reused for every sheet.
+    Outlines are reused from the previous sheet of the same size when the
+    registration cache can verify them ('outline_reused' stage).
+
+    Every intermediate image is leased from the process's buffer pool and
+    handed back before returning.
+
+    Returns (detected, fills, layout) where `detected` holds one int8
+    option index per question (-1 for blank) and `fills` is the
+    (questions, options) fill-ratio matrix.
     """
-    bubble_coords = []
-    
-    # Configuration for bubble layout - ADJUST THESE VALUES
-    start_x = 50 
-    start_y = 100 
-    question_height = 30
-    subject_width = 160
-    bubble_width = 140
-    bubble_height = 20
-    
-    for subject in range(5):
-        x_pos = start_x + (subject * subject_width)
-        
-        for question in range(20):
-            y_pos = start_y + (question * question_height)
-            
-            bubble_coords.append({
-                'x': x_pos,
-                'y': y_pos, 
-                'width': bubble_width,
-                'height': bubble_height
-            })
-    
-    return bubble_coords
-
-def evaluate_omr_sheet(image_path, answer_key):
+    with get_buffer_pool().lease() as buffers:
+        return _read_answers(image, layout_id, interpolation, buffers)
+
+def _read_answers(image, layout_id, interpolation, buffers):
+    start = time.perf_counter()
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=buffers.get(image.shape[:2]))
+    else:
+        gray = image
+    registration = get_registration_cache()
+    corners = registration.match(gray) if registration is not None else None
+    if corners is not None:
+        observe_stage('outline_reused', time.perf_counter() - start)
+    else:
+        corners = get_sheet_outline(gray, buffers=buffers)
+        if corners is not None and registration is not None:
+            registration.store(gray, corners)
+        observe_stage('outline', time.perf_counter() - start)
+    if corners is None:
+        raise ValueError('Invalid document. OMR sheet not detected.')
+
+    with timed('warp'):
+        width, height = compile_layout(layout_id).sheet_size
+        warped = get_warped_image(gray, corners, size=(width, height), interpolation=interpolation,
+                                  dst=buffers.get((height, width)))
+
+    layout = compile_layout(layout_id, warped.shape[1], warped.shape[0])
+    logger.debug("Warped sheet to %s using layout '%s' (%d questions)",
+                 warped.shape[1::-1], layout.layout_id, len(layout.boxes))
+
+    # Threshold the sheet once and score every bubble in a single pass
+    with timed('scoring'):
+        mask = threshold_sheet(warped, out=buffers.get(warped.shape))
+        fills = compute_fill_matrix(mask, layout.boxes, options=layout.options,
+                                    integral=buffers.get((height + 1, width + 1), np.int32))
+        detected = pick_answers(fills)
+    return detected, fills, layout
+
+def evaluate_omr_image(image, answer_key, label='<memory>', layout_id=None, return_answers=False):
     """
-    Evaluates a single OMR sheet image using a dictionary-based answer key.
+    Evaluates an already decoded OMR sheet image (BGR array). `answer_key`
+    is either a CompiledKey from the answer-key registry or a
+    {subject: [option, ...]} dict, which is compiled against `layout_id`.
+
+    Returns (scores, total_score), plus the detected answers as a list
+    (-1 for blank; None on failure) when `return_answers` is set.
     """
-    print(f"Evaluating sheet: {image_path}")
-    print(f"Answer key: {list(answer_key.keys())}")
-    
-    # Use a fixed list of subject names based on the answer_key dictionary
-    subject_names = list(answer_key.keys())
-    
-    # Initialize scores_by_subject with subject names
-    scores_by_subject = {name: 0 for name in subject_names}
-    total_correct = 0
-    
     try:
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError(f"Could not load image from {image_path}")
-        
-        print(f"Image loaded successfully. Shape: {image.shape}")
-        
-        corners = get_sheet_outline(image)
-        if corners is None:
-            return {'error': 'Invalid document. OMR sheet not detected.'}, None
-        
-        warped = get_warped_image(image, corners)
-        print("Applied perspective correction")
-        
-        bubble_coords = generate_bubble_coordinates(warped.shape[1], warped.shape[0])
-        print(f"Generated {len(bubble_coords)} bubble coordinates")
-        
-        FILL_THRESHOLD = 0.05
-        
-        for i, bubble_coord in enumerate(bubble_coords):
-            # Check if we have an answer for this question
-            if i >= 100:  # Assuming 100 questions total
-                break
-            
-            x, y, w, h = bubble_coord['x'], bubble_coord['y'], bubble_coord['width'], bubble_coord['height']
-            
-            x = max(0, min(x, warped.shape[1] - w))
-            y = max(0, min(y, warped.shape[0] - h))
-            w = min(w, warped.shape[1] - x)
-            h = min(h, warped.shape[0] - y)
-            
-            roi = warped[y:y+h, x:x+w]
-            
-            if roi.size == 0:
-                continue
-            
-            try:
-                bubble_intensities = detect_bubbles(roi)
-                max_intensity = max(bubble_intensities)
-                detected_answer = bubble_intensities.index(max_intensity)
-                
-                # Check for a sufficiently filled bubble
-                if max_intensity > FILL_THRESHOLD:
-                    # Map question index to subject and question number within that subject
-                    subject_index = i // 20
-                    subject_name = subject_names[subject_index]
-                    question_in_subject_index = i % 20
-                    
-                    correct_answer = answer_key[subject_name][question_in_subject_index]
-                    
-                    if detected_answer == correct_answer:
-                        scores_by_subject[subject_name] += 1
-                        total_correct += 1
-                        
-                    print(f"Q{i+1}: Detected={chr(65+detected_answer)}, "
-                          f"Correct={chr(65+correct_answer)}, "
-                          f"Match={'✓' if detected_answer == correct_answer else '✗'}, "
-                          f"Intensity={max_intensity:.3f}")
+        if not isinstance(answer_key, CompiledKey):
+            answer_key = compile_answer_key(answer_key, layout_id=layout_id)
+        logger.debug("Evaluating sheet %s (shape %s) against key %s",
+                     label, image.shape, answer_key.version or 'custom')
+
+        detected, fills, layout = read_answers(image, answer_key.layout_id)
+        with timed('grading'):
+            scores_by_subject, total_correct = grade_answers(detected, answer_key)
+
+        # Per-question detail is only built when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, (detected_answer, correct_answer) in enumerate(zip(detected, answer_key.answers)):
+                max_intensity = fills[i].max()
+                if correct_answer < 0:
+                    continue
+
+                if detected_answer >= 0:
+                    logger.debug(f"Q{i+1}: Detected={chr(65+detected_answer)}, "
+                                 f"Correct={chr(65+correct_answer)}, "
+                                 f"Match={'✓' if detected_answer == correct_answer else '✗'}, "
+                                 f"Fill={max_intensity:.3f}")
                 else:
-                    print(f"Q{i+1}: No clear answer detected (max intensity: {max_intensity:.3f})")
-
-            except Exception as e:
-                print(f"Error processing question {i+1}: {str(e)}")
-                continue
-        
-        print(f"\nEvaluation Complete:")
-        print(f"Total correct: {total_correct}/100")
-        print(f"Scores by subject: {scores_by_subject}")
-        
+                    logger.debug(f"Q{i+1}: No clear answer detected (max fill: {max_intensity:.3f})")
+
+        logger.info("Evaluated %s: %d/%d correct, by subject %s",
+                    label, total_correct, answer_key.max_score, scores_by_subject)
+
+        if return_answers:
+            return scores_by_subject, total_correct, detected.tolist()
         return scores_by_subject, total_correct
-        
+
     except Exception as e:
-        print(f"Error in evaluate_omr_sheet: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        
-        scores_by_subject = {name: 0 for name in subject_names}
-        return {'error': str(e)}, 0
\ No newline at end of file
+        logger.exception("Error evaluating %s: %s", label, e)
+
+        return ({'error': str(e)}, 0, None) if return_answers else ({'error': str(e)}, 0)
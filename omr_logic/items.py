@@ -0,0 +1,184 @@
+"""
+Per-question responses and item analysis.
+
+Each results row keeps the answers read from the sheet in `answers`, a
+BLOB of one 4-bit code per question (0 for blank, option + 1 otherwise),
+so a 100-question sheet costs 50 bytes. The writer also adds every row
+to the item_stats counters in the same transaction: per version,
+layout, question and option, how many sheets chose it and the sum (and sum of
+squares) of those sheets' total scores. Item statistics for any number
+of sheets are then read from a few hundred counter rows.
+
+Which option is correct is taken from the answer key at query time, so
+the statistics follow key corrections without touching the counters.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from .layout import compile_layout
+
+BLANK_CODE = 0
+
+
+def pack_answers(answers):
+    """Pack detected answers (option index, -1 for blank) into 4 bits each."""
+    codes = np.asarray(answers, dtype=np.int16) + 1
+    if codes.size and (codes.min() < 0 or codes.max() > 15):
+        raise ValueError('Answers must be -1 (blank) or an option index below 15')
+    codes = codes.astype(np.uint8)
+    if codes.size % 2:
+        codes = np.append(codes, BLANK_CODE)
+    return ((codes[0::2] << 4) | codes[1::2]).tobytes()
+
+
+def unpack_answers(blob, count):
+    """Inverse of pack_answers: an int8 array of `count` answers, -1 for blank."""
+    return unpack_answer_matrix([blob], count)[0]
+
+
+def unpack_answer_matrix(blobs, count):
+    """
+    Unpack many answer BLOBs of the same layout at once into an int8
+    (len(blobs), count) matrix, -1 for blank.
+    """
+    packed = np.frombuffer(b''.join(blobs), dtype=np.uint8).reshape(len(blobs), -1)
+    codes = np.empty((len(blobs), packed.shape[1] * 2), dtype=np.int8)
+    codes[:, 0::2] = packed >> 4
+    codes[:, 1::2] = packed & 0x0F
+    return codes[:, :count] - 1
+
+
+def _count_responses(rows):
+    """
+    Sum the rows' responses into {(version, layout_id): (count,
+    score_sum, score_sumsq)} arrays of shape (questions, options + 1);
+    column 0 counts blanks. Rows stored without a layout count under the
+    default one.
+    """
+    groups = defaultdict(list)
+    for row in rows:
+        if row.get('answers') is not None:
+            groups[(row['sheet_version'], row.get('layout_id'))].append(row)
+
+    counters = {}
+    for (version, layout_id), group in groups.items():
+        layout = compile_layout(layout_id)
+        questions = len(layout.boxes)
+        codes = unpack_answer_matrix([row['answers'] for row in group], questions) + 1
+        totals = np.array([row['total_score'] or 0 for row in group], dtype=np.int64)
+
+        shape = (questions, layout.options + 1)
+        count, score_sum, score_sumsq = np.zeros(shape, np.int64), np.zeros(shape, np.int64), np.zeros(shape, np.int64)
+        question_index = np.broadcast_to(np.arange(questions), codes.shape)
+        weights = np.broadcast_to(totals[:, None], codes.shape)
+        np.add.at(count, (question_index, codes), 1)
+        np.add.at(score_sum, (question_index, codes), weights)
+        np.add.at(score_sumsq, (question_index, codes), weights * weights)
+        counters[(version, layout.layout_id)] = (count, score_sum, score_sumsq)
+    return counters
+
+
+def update_item_stats(conn, rows, sign=1):
+    """
+    Add (sign 1) or remove (sign -1) result rows' responses to the
+    item_stats counters, inside the caller's transaction. Rows without
+    answers are skipped.
+    """
+    params = []
+    for (version, layout_id), (count, score_sum, score_sumsq) in _count_responses(rows).items():
+        for question, code in zip(*np.nonzero(count)):
+            params.append((version, layout_id, int(question), int(code) - 1, sign * int(count[question, code]),
+                           sign * int(score_sum[question, code]), sign * int(score_sumsq[question, code])))
+    conn.executemany('''
+        INSERT INTO item_stats (sheet_version, layout_id, question, option, count, score_sum, score_sumsq)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (sheet_version, layout_id, question, option) DO UPDATE SET
+            count = count + excluded.count,
+            score_sum = score_sum + excluded.score_sum,
+            score_sumsq = score_sumsq + excluded.score_sumsq
+    ''', params)
+
+
+def rebuild_item_stats(conn, batch_size=1000):
+    """Recompute item_stats from a full scan of the stored answers."""
+    conn.execute('DELETE FROM item_stats')
+    cursor = conn.execute(
+        'SELECT sheet_version, layout_id, answers, total_score FROM results WHERE answers IS NOT NULL'
+    )
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        update_item_stats(conn, [dict(zip(('sheet_version', 'layout_id', 'answers', 'total_score'), row))
+                                 for row in rows])
+
+
+def _option_label(option):
+    return 'blank' if option < 0 else chr(ord('A') + option)
+
+
+def item_stats(conn, version, answer_key):
+    """
+    Item analysis for one version from the item_stats counters, or None
+    if no sheet of that version has stored answers. Only sheets read on
+    the key's layout are included; questions on other layouts do not
+    line up with the key.
+
+    Per question: `difficulty` is the share of sheets answering it
+    correctly, `discrimination` the point-biserial correlation between
+    answering it correctly and the total score, and `options` the count,
+    share and mean total score of the sheets choosing each option
+    (including blank). Questions the key does not score have neither.
+    """
+    rows = conn.execute(
+        'SELECT question, option, count, score_sum, score_sumsq FROM item_stats '
+        'WHERE sheet_version = ? AND layout_id = ? AND count > 0 ORDER BY question, option',
+        (version, answer_key.layout_id)
+    ).fetchall()
+    if not rows:
+        return None
+
+    by_question = defaultdict(dict)
+    for question, option, count, score_sum, score_sumsq in rows:
+        by_question[question][option] = (count, score_sum, score_sumsq)
+
+    # Every sheet chose exactly one option (or blank) on every question,
+    # so any one question's counters add up to the whole population
+    first = next(iter(by_question.values()))
+    n = sum(c for c, _, _ in first.values())
+    mean = sum(s for _, s, _ in first.values()) / n
+    std = max(sum(q for _, _, q in first.values()) / n - mean * mean, 0.0) ** 0.5
+
+    layout = compile_layout(answer_key.layout_id)
+    question_numbers = layout.question_index + 1
+    items = []
+    for question in sorted(by_question):
+        options = by_question[question]
+        correct = int(answer_key.answers[question]) if question < len(answer_key.answers) else -1
+        item = {
+            'question': question + 1,
+            'subject': layout.subjects[layout.subject_index[question]] if question < len(layout.boxes) else None,
+            'number': int(question_numbers[question]) if question < len(layout.boxes) else None,
+            'key': _option_label(correct) if correct >= 0 else None,
+            'options': {
+                _option_label(option): {
+                    'count': count,
+                    'share': round(count / n, 4),
+                    'mean_score': round(score_sum / count, 2),
+                }
+                for option, (count, score_sum, _) in options.items()
+            },
+        }
+        if correct >= 0:
+            count, score_sum, _ = options.get(correct, (0, 0, 0))
+            p = count / n
+            item['difficulty'] = round(p, 4)
+            if 0 < p < 1 and std > 0:
+                item['discrimination'] = round((score_sum / count - mean) / std * (p / (1 - p)) ** 0.5, 4)
+            else:
+                item['discrimination'] = None
+        items.append(item)
+
+    return {'version': version, 'count': n, 'mean_score': round(mean, 3), 'std_score': round(std, 3),
+            'items': items}
@@ -0,0 +1,247 @@
+"""
+SQLite-backed grading job queue.
+
+Uploads are stored as `queued` rows in the jobs table. Worker processes
+claim a job by taking a lease on it, grade it, and write the result row
+and the job's outcome in one transaction. A worker that dies mid-sheet
+simply lets its lease expire; the job is then claimed again, up to
+MAX_ATTEMPTS times before it is marked failed.
+
+Run the workers next to the web app with:
+
+    python -m omr_logic.jobs --workers 4
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import uuid
+
+from .answer_keys import AnswerKeyRegistry
+from .batch import cache_value, cached_result, grade_sheet_bytes, sheet_error
+from .cache import ResultCache, cache_key, image_digest
+from .db import DB_PATH, connect, get_connection, init_db, insert_results, result_row
+from .metrics import Gauge
+from .runtime import init_pool_worker
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.25
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+def submit_job(conn, data, filename, student_id, version):
+    """Queue one sheet for grading and return its job id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with conn:
+        conn.execute(
+            'INSERT INTO jobs (id, student_id, sheet_version, filename, payload, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, student_id, version, filename, data, now, now)
+        )
+    return job_id
+
+
+def get_job(conn, job_id):
+    """Return a job's public fields as a dict, or None if it does not exist."""
+    row = conn.execute(
+        'SELECT id, status, student_id, sheet_version, filename, result, attempts, created_at, updated_at '
+        'FROM jobs WHERE id = ?', (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['version'] = job.pop('sheet_version')
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def queue_depth(conn):
+    """Return {status: job count} for every job status."""
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    return {status: counts.get(status, 0) for status in JOB_STATUSES}
+
+
+def _expire_exhausted(conn, now):
+    """Fail jobs whose lease ran out on their last allowed attempt."""
+    result = json.dumps({
+        'status': 'error',
+        'error': 'System Error',
+        'error_type': 'PROCESSING_ERROR',
+        'details': f'Grading worker stopped while processing this sheet {MAX_ATTEMPTS} times',
+    })
+    conn.execute(
+        "UPDATE jobs SET status = 'failed', result = ?, payload = NULL, updated_at = ? "
+        "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+        (result, now, now, MAX_ATTEMPTS)
+    )
+
+
+def claim_job(conn, worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    Lease the oldest runnable job to `worker_id`: a queued job, or a
+    running one whose previous worker's lease has expired. The claim is a
+    single UPDATE ... RETURNING, so two workers never get the same job.
+    """
+    now = time.time()
+    with conn:
+        _expire_exhausted(conn, now)
+        row = conn.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, "
+            "attempts = attempts + 1, updated_at = ? "
+            "WHERE id = ("
+            "  SELECT id FROM jobs WHERE status = 'queued' "
+            "  OR (status = 'running' AND lease_until < ?) "
+            "  ORDER BY created_at LIMIT 1"
+            ") RETURNING id, student_id, sheet_version, filename, payload, attempts",
+            (worker_id, now + lease_seconds, now, now)
+        ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def finish_job(conn, job_id, worker_id, result, row=None):
+    """
+    Record a job's outcome, and its results row if it succeeded, in one
+    transaction. Does nothing if the lease has passed to another worker.
+    """
+    status = 'done' if result['status'] == 'success' else 'failed'
+    with conn:
+        updated = conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, payload = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (status, json.dumps(result), time.time(), job_id, worker_id)
+        ).rowcount
+        if updated and row is not None:
+            insert_results(conn, [row])
+    return bool(updated)
+
+
+def process_job(conn, job, answer_keys, worker_id, cache=None):
+    """Grade one claimed job and record its outcome."""
+    item = {
+        'index': 0,
+        'filename': job['filename'],
+        'student_id': job['student_id'],
+        'version': job['sheet_version'],
+        'data': job['payload'],
+        'image_hash': image_digest(job['payload']),
+    }
+    answer_key = answer_keys.get(item['version'])
+    if answer_key is None:
+        result = sheet_error(item, 'Invalid exam version', 'VALIDATION_ERROR',
+                             f'Version "{item["version"]}" not found')
+    else:
+        key = cache_key(item['data'], answer_key, item['image_hash']) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            result = cached_result(item, cached)
+        else:
+            result = grade_sheet_bytes(item, answer_key)
+            result.pop('timings', None)
+            if key is not None and result['status'] == 'success':
+                cache.put(key, cache_value(result))
+
+    row = None
+    if result['status'] == 'success':
+        result['max_possible_score'] = answer_key.max_score
+        row = result_row(item['student_id'], item['version'], answer_key,
+                         result['scores'], result['total_score'], result.get('answers'), item['image_hash'])
+    for internal in ('index', 'answers', 'image_hash'):
+        result.pop(internal, None)
+
+    if not finish_job(conn, job['id'], worker_id, result, row):
+        logger.warning("Lost the lease on job %s before finishing it", job['id'])
+
+
+def run_worker(path=DB_PATH, poll_interval=POLL_INTERVAL, lease_seconds=LEASE_SECONDS):
+    """Claim and grade jobs until the process is told to stop."""
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    init_pool_worker()
+    conn = connect(path)
+    answer_keys = AnswerKeyRegistry()
+    cache = ResultCache(path)
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.append(True))
+    parent = os.getppid()
+    logger.info("Job worker %s started", worker_id)
+
+    # Also stop if the process that started us goes away
+    while not stopping and os.getppid() == parent:
+        try:
+            job = claim_job(conn, worker_id, lease_seconds)
+        except Exception:
+            logger.exception("Failed to claim a job")
+            job = None
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            process_job(conn, job, answer_keys, worker_id, cache)
+        except Exception:
+            # Leave the lease to expire so the job is retried elsewhere
+            logger.exception("Job %s failed in worker %s", job['id'], worker_id)
+
+    conn.close()
+    logger.info("Job worker %s stopped", worker_id)
+
+
+def _spawn(path):
+    process = multiprocessing.Process(target=run_worker, args=(path,), name='omr-job-worker', daemon=True)
+    process.start()
+    return process
+
+
+def start_workers(count, path=DB_PATH):
+    """Start `count` worker processes in the background and return them."""
+    return [_spawn(path) for _ in range(count)]
+
+
+def supervise(count, path=DB_PATH):
+    """Run `count` workers, restarting any that die, until SIGINT/SIGTERM."""
+    init_db(path)
+    workers = start_workers(count, path)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    try:
+        while not stopping:
+            time.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.warning("Job worker %s exited with %s, restarting", process.pid, process.exitcode)
+                    workers[i] = _spawn(path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(LEASE_SECONDS)
+
+
+JOB_QUEUE_DEPTH = Gauge('omr_job_queue_depth', 'Grading jobs, by status.',
+                        fn=lambda: queue_depth(get_connection()), label='status')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run OMR grading job workers.')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('OMR_JOB_WORKERS') or os.cpu_count() or 1),
+                        help='number of worker processes (default: OMR_JOB_WORKERS or CPU count)')
+    parser.add_argument('--db', default=DB_PATH, help='results database path')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('OMR_LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    supervise(args.workers, args.db)
+
+
+if __name__ == '__main__':
+    main()
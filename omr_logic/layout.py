@@ -0,0 +1,118 @@
+import json
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'subject_config.json')
+
+# A layout compiled for one sheet resolution. `boxes` holds one
+# (x, y, w, h) row per question; each row is split into `options`
+# equal-width bubbles by the scoring engine.
+CompiledLayout = namedtuple('CompiledLayout', [
+    'layout_id',
+    'sheet_size',
+    'options',
+    'subjects',
+    'question_counts',
+    'subject_index',
+    'question_index',
+    'boxes',
+])
+
+
+@lru_cache(maxsize=None)
+def load_layouts(config_path=CONFIG_PATH):
+    """
+    Read the sheet layout definitions from subject_config.json.
+
+    Returns (default_layout_id, {layout_id: definition}). Layouts that do
+    not list their own subjects use the top-level "subjects" list.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+
+    subjects = config.get('subjects', [])
+    layouts = {}
+    for layout_id, definition in config.get('layouts', {}).items():
+        definition = dict(definition)
+        definition.setdefault('subjects', subjects)
+        layouts[layout_id] = definition
+
+    if not layouts:
+        raise ValueError(f"No sheet layouts defined in {config_path}")
+
+    default_layout = config.get('default_layout') or next(iter(layouts))
+    return default_layout, layouts
+
+
+def resolve_layout_id(layout_id=None):
+    default_layout, layouts = load_layouts()
+    layout_id = layout_id or default_layout
+    if layout_id not in layouts:
+        raise KeyError(f"Unknown sheet layout '{layout_id}'")
+    return layout_id
+
+
+@lru_cache(maxsize=64)
+def _compile(layout_id, width, height):
+    _, layouts = load_layouts()
+    definition = layouts[layout_id]
+
+    ref_w, ref_h = definition['sheet_size']
+    origin_x, origin_y = definition['origin']
+    bubble_w, bubble_h = definition['bubble_size']
+    column_pitch = definition['column_pitch']
+    row_pitch = definition['row_pitch']
+
+    subjects = tuple(s['name'] for s in definition['subjects'])
+    question_counts = tuple(int(s['questions']) for s in definition['subjects'])
+
+    subject_index = np.repeat(np.arange(len(subjects)), question_counts)
+    question_index = np.concatenate([np.arange(n) for n in question_counts])
+
+    # One column per subject, one row per question, in the reference frame
+    x = origin_x + subject_index * column_pitch
+    y = origin_y + question_index * row_pitch
+
+    # Scale to the target resolution
+    sx, sy = width / ref_w, height / ref_h
+    boxes = np.stack([
+        np.round(x * sx),
+        np.round(y * sy),
+        np.full_like(x, round(bubble_w * sx)),
+        np.full_like(y, round(bubble_h * sy)),
+    ], axis=1).astype(np.int32)
+
+    subject_index = subject_index.astype(np.int16)
+    question_index = question_index.astype(np.int16)
+    for array in (subject_index, question_index, boxes):
+        array.flags.writeable = False
+
+    return CompiledLayout(
+        layout_id=layout_id,
+        sheet_size=(width, height),
+        options=int(definition['options']),
+        subjects=subjects,
+        question_counts=question_counts,
+        subject_index=subject_index,
+        question_index=question_index,
+        boxes=boxes,
+    )
+
+
+def compile_layout(layout_id=None, width=None, height=None):
+    """
+    Return the compiled bubble layout for a sheet template at the given
+    resolution (the template's own sheet_size if omitted).
+
+    Results are cached per (layout_id, width, height), so coordinates are
+    computed once per process rather than once per sheet. The returned
+    arrays are read-only because they are shared between callers.
+    """
+    layout_id = resolve_layout_id(layout_id)
+    if width is None or height is None:
+        _, layouts = load_layouts()
+        width, height = layouts[layout_id]['sheet_size']
+    return _compile(layout_id, int(width), int(height))
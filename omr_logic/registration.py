@@ -0,0 +1,114 @@
+"""
+Registration cache for runs of sheets with the same placement.
+
+Flatbed and sheet-fed scans put every page of a batch in nearly the same
+spot, so the outline found on one page is a good guess for the next. The
+cache keeps, per image size, the corners last found by full outline
+detection plus a small patch of the image around each corner. A new page
+reuses those corners when every patch is found again, by normalised
+cross-correlation, within a few pixels of where it was; the corners
+follow whatever small shift the match finds. Anything else falls back
+to full detection.
+
+Only scanner runs benefit, and a reused outline makes a sheet's grade
+depend on the page before it, so the cache is off unless a process turns
+it on with enable_registration_cache(): the batch and pages pool, the
+command-line grader and the benchmark do; single uploads and queued jobs
+always detect the outline from scratch.
+
+Reuse shows up as the 'outline_reused' stage instead of 'outline' in
+omr_stage_seconds, so the reuse rate is visible in /metrics and in
+benchmark reports, including for sheets graded in pool workers.
+"""
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from .utils import outline_downscale_factor, refine_corners
+
+REGISTRATION_CACHE = os.environ.get('OMR_REGISTRATION_CACHE', '1') != '0'
+
+PATCH_FRACTION = 0.02     # corner patch half-size, as a fraction of the longer image side
+SEARCH_FRACTION = 0.01    # how far a corner may move between sheets, likewise
+MIN_PATCH_STD = 8.0       # patches flatter than this (no sheet edge in view) cannot be matched
+MIN_MATCH_SCORE = 0.9     # normalised cross-correlation every corner must reach
+MAX_ENTRIES = 8           # image sizes remembered at once
+
+
+class RegistrationCache:
+    """Per-process cache of the last detected sheet corners, by image size."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _geometry(shape):
+        longest = max(shape[:2])
+        return max(8, int(round(PATCH_FRACTION * longest))), max(4, int(round(SEARCH_FRACTION * longest)))
+
+    def store(self, gray, corners):
+        """Remember `corners` for images of this size, if their patches can be matched later."""
+        half, search = self._geometry(gray.shape)
+        height, width = gray.shape[:2]
+        patches = []
+        for x, y in np.rint(corners).astype(int):
+            # The search window must fit in the frame; a flat scan whose
+            # corners are the frame corners has nothing to track anyway
+            if not (half + search <= x < width - half - search and half + search <= y < height - half - search):
+                return False
+            patch = gray[y - half:y + half + 1, x - half:x + half + 1].copy()
+            if patch.std() < MIN_PATCH_STD:
+                return False
+            patches.append(patch)
+
+        with self._lock:
+            if gray.shape not in self._entries and len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[gray.shape] = (np.asarray(corners, dtype=np.float32), patches)
+        return True
+
+    def match(self, gray):
+        """
+        Corners for `gray` from the cached entry for its size, shifted by
+        what the patch match finds; None if any corner fails to match.
+        """
+        entry = self._entries.get(gray.shape)
+        if entry is None:
+            return None
+        corners, patches = entry
+        half, search = self._geometry(gray.shape)
+
+        matched = corners.copy()
+        for i, ((x, y), patch) in enumerate(zip(np.rint(corners).astype(int), patches)):
+            window = gray[y - half - search:y + half + search + 1, x - half - search:x + half + search + 1]
+            scores = cv2.matchTemplate(window, patch, cv2.TM_CCOEFF_NORMED)
+            _, best, _, (dx, dy) = cv2.minMaxLoc(scores)
+            if not best >= MIN_MATCH_SCORE:  # also rejects NaN from a flat window
+                return None
+            matched[i] += (dx - search, dy - search)
+        # The match is only pixel-accurate; refine to sub-pixel like a detected outline
+        return refine_corners(gray, matched, outline_downscale_factor(gray))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+
+
+def enable_registration_cache():
+    """Turn the cache on for this process, unless OMR_REGISTRATION_CACHE=0."""
+    global _cache
+    if REGISTRATION_CACHE and _cache is None:
+        _cache = RegistrationCache()
+    return _cache
+
+
+def get_registration_cache():
+    """The process-wide cache, or None unless enable_registration_cache() turned it on."""
+    return _cache
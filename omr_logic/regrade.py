@@ -0,0 +1,180 @@
+"""
+Re-grade stored results against a corrected answer key.
+
+When a key turns out to be wrong after the exam, the stored per-question
+answers (see omr_logic.items) are enough to rescore every sheet without
+touching an image. Results of one version are read in chunks of
+`chunk_size` rows, unpacked into an answer matrix and scored against the
+key in one vectorized comparison; rows whose scores change are updated
+in one transaction per chunk. The per-version aggregates follow through
+their triggers and the item_stats counters are adjusted alongside.
+
+Edit data/answer_keys.json, then run:
+
+    python -m omr_logic.regrade --version B --dry-run
+    python -m omr_logic.regrade --version B
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from collections import Counter as Tally
+
+import numpy as np
+
+from .answer_keys import ANSWER_KEYS_PATH, AnswerKeyRegistry
+from .db import DB_PATH, SCORE_COLUMNS, connect
+from .items import unpack_answer_matrix, update_item_stats
+from .layout import compile_layout
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+
+SUBJECT_COLUMNS = SCORE_COLUMNS[:-1]
+
+
+def score_matrix(answers, answer_key):
+    """
+    Score an (sheets, questions) answer matrix against a compiled key.
+
+    Returns an int32 (sheets, 6) matrix: the subjectN columns in the
+    order result_row stores them (None-padded columns score 0), then the
+    total score.
+    """
+    layout_subjects = compile_layout(answer_key.layout_id).subjects
+    correct = (answers == answer_key.answers) & (answer_key.answers >= 0)
+    # (questions, subjects) indicator, so one matrix product sums every subject of every sheet
+    membership = np.zeros((len(answer_key.answers), len(layout_subjects)), dtype=np.int32)
+    membership[np.arange(len(answer_key.answers)), answer_key.subject_index] = 1
+    per_subject = correct.astype(np.int32) @ membership
+
+    scores = np.zeros((len(answers), len(SCORE_COLUMNS)), dtype=np.int32)
+    for i, name in enumerate(list(answer_key.subjects)[:len(SUBJECT_COLUMNS)]):
+        scores[:, i] = per_subject[:, layout_subjects.index(name)]
+    scores[:, -1] = np.count_nonzero(correct, axis=1)
+    return scores
+
+
+def _update_chunk(conn, rows, old, new, changed, answer_key):
+    """Write the changed rows' scores and move their item_stats contributions."""
+    subject_count = min(len(answer_key.subjects), len(SUBJECT_COLUMNS))
+    columns = list(SUBJECT_COLUMNS[:subject_count]) + ['total_score']
+    values = np.concatenate([new[:, :subject_count], new[:, -1:]], axis=1)
+    assignments = ', '.join(f'{c} = ?' for c in columns)
+
+    def details(totals):
+        return [{'sheet_version': rows[i]['sheet_version'], 'layout_id': rows[i]['layout_id'],
+                 'answers': rows[i]['answers'], 'total_score': int(totals[i])} for i in changed]
+
+    with conn:
+        conn.executemany(
+            f'UPDATE results SET {assignments} WHERE id = ?',
+            [tuple(int(v) for v in values[i]) + (rows[i]['id'],) for i in changed]
+        )
+        update_item_stats(conn, details(old[:, -1]), sign=-1)
+        update_item_stats(conn, details(new[:, -1]), sign=1)
+
+
+def regrade_version(conn, version, answer_key, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Rescore every stored result of `version` against `answer_key` and
+    return a report of the score changes. With `dry_run`, nothing is
+    written.
+
+    Rows stored without answers, or read on another layout than the
+    key's, cannot be rescored and are only counted (`not_regraded`).
+    """
+    start = time.perf_counter()
+    questions = len(answer_key.answers)
+    subjects = list(answer_key.subjects)[:len(SUBJECT_COLUMNS)]
+    sheets = changed_count = 0
+    deltas = Tally()
+    subject_delta_sums = np.zeros(len(subjects), dtype=np.int64)
+    min_delta = max_delta = 0
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, sheet_version, layout_id, answers, {', '.join(SCORE_COLUMNS)} FROM results "
+            "WHERE sheet_version = ? AND layout_id = ? AND answers IS NOT NULL AND id > ? "
+            "ORDER BY id LIMIT ?",
+            (version, answer_key.layout_id, last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+
+        answers = unpack_answer_matrix([row['answers'] for row in rows], questions)
+        old = np.array([[row[c] or 0 for c in SCORE_COLUMNS] for row in rows], dtype=np.int32)
+        new = score_matrix(answers, answer_key)
+
+        delta = new - old
+        changed = np.flatnonzero((delta != 0).any(axis=1))
+        if changed.size and not dry_run:
+            _update_chunk(conn, rows, old, new, changed, answer_key)
+
+        total_delta = delta[:, -1]
+        deltas.update(total_delta.tolist())
+        subject_delta_sums += delta[:, :len(subjects)].sum(axis=0)
+        min_delta, max_delta = min(min_delta, int(total_delta.min())), max(max_delta, int(total_delta.max()))
+        sheets += len(rows)
+        changed_count += changed.size
+
+    not_regraded = conn.execute(
+        'SELECT COUNT(*) FROM results WHERE sheet_version = ? '
+        'AND (answers IS NULL OR layout_id IS NOT ?)',
+        (version, answer_key.layout_id)
+    ).fetchone()[0]
+    seconds = time.perf_counter() - start
+    logger.info("Re-graded %d sheets of version %s in %.2fs: %d changed%s",
+                sheets, version, seconds, changed_count, ' (dry run)' if dry_run else '')
+
+    return {
+        'version': version,
+        'dry_run': dry_run,
+        'sheets': sheets,
+        'changed': changed_count,
+        'not_regraded': not_regraded,
+        'max_possible_score': answer_key.max_score,
+        'total_delta': {
+            'mean': round(sum(d * n for d, n in deltas.items()) / sheets, 3) if sheets else 0.0,
+            'min': min_delta,
+            'max': max_delta,
+        },
+        'subject_mean_delta': {name: round(int(total) / sheets, 3) if sheets else 0.0
+                               for name, total in zip(subjects, subject_delta_sums)},
+        'deltas': {delta: count for delta, count in sorted(deltas.items())},
+        'seconds': round(seconds, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-grade stored results against the current answer keys.')
+    parser.add_argument('--version', required=True, action='append',
+                        help='exam version to re-grade (repeat for several)')
+    parser.add_argument('--db', default=DB_PATH, help='results database path')
+    parser.add_argument('--answer-keys', default=ANSWER_KEYS_PATH, help='answer key file')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows rescored per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='report the score changes without writing them')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.environ.get('OMR_LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    keys = AnswerKeyRegistry(args.answer_keys).snapshot()
+    missing = [v for v in args.version if v not in keys]
+    if missing:
+        parser.error(f"no answer key for version(s) {', '.join(missing)} in {args.answer_keys}")
+
+    conn = connect(args.db)
+    try:
+        for version in args.version:
+            report = regrade_version(conn, version, keys[version], args.chunk_size, args.dry_run)
+            print(json.dumps(report))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Process-level tuning: native thread budgets and pipeline warm-up.
+
+This module imports cv2 and numpy lazily, so a launcher can call
+limit_native_threads() before anything else loads them; the BLAS and
+OpenMP libraries size their thread pools once, at import.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+NATIVE_THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+)
+
+
+def cpu_budget():
+    """Cores this deployment may use: OMR_CPU_BUDGET, else the cores we are allowed to run on."""
+    if os.environ.get('OMR_CPU_BUDGET'):
+        return max(1, int(os.environ['OMR_CPU_BUDGET']))
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def threads_per_worker(workers, concurrency=1, cores=None):
+    """Native threads each of `workers` processes (each running `concurrency` requests) may use."""
+    cores = cores or cpu_budget()
+    return max(1, cores // max(1, workers * concurrency))
+
+
+def limit_native_threads(threads):
+    """Cap BLAS/OpenMP pools for this process and its children. Call before numpy is imported."""
+    for var in NATIVE_THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+
+def configure_threads(threads):
+    """Set OpenCV's worker thread count for this process."""
+    import cv2
+    cv2.setNumThreads(threads)
+    limit_native_threads(threads)
+
+
+def init_pool_worker():
+    """
+    Initializer for grading process pools: each pool process grades one
+    sheet at a time, so OpenCV's own threads would only compete with the
+    other pool processes for the same cores.
+    """
+    configure_threads(1)
+
+
+def init_scan_worker():
+    """
+    init_pool_worker for pools grading scanner runs (batch and pages
+    uploads, the command-line grader): also turns on the registration
+    cache, so pages placed like the one before reuse its outline.
+    """
+    from .registration import enable_registration_cache
+
+    init_pool_worker()
+    enable_registration_cache()
+
+
+def warm_up(answer_keys=None, layout_id=None):
+    """
+    Run one synthetic sheet through decode, validation and evaluation so
+    the first real request does not pay for lazy imports, layout and key
+    compilation, or OpenCV's first-call setup. Returns seconds taken.
+    """
+    import time
+
+    import cv2
+    import numpy as np
+
+    from .answer_keys import compile_answer_key
+    from .evaluation import evaluate_omr_image
+    from .synthetic import make_sheet
+    from .utils import decode_image
+    from .validation import basic_image_validation
+
+    start = time.perf_counter()
+    image, truth = make_sheet(np.random.default_rng(0), layout_id)
+    _, encoded = cv2.imencode('.jpg', image)
+    image = decode_image(encoded.tobytes())
+    basic_image_validation(image)
+
+    keys = list(answer_keys.snapshot().values()) if answer_keys is not None else []
+    if not keys:
+        keys = [compile_answer_key({}, layout_id=truth['layout_id'])]
+    warmed = set()
+    for key in keys:
+        if key.layout_id not in warmed:
+            evaluate_omr_image(image, key, label='<warm-up>', layout_id=key.layout_id)
+            warmed.add(key.layout_id)
+
+    elapsed = time.perf_counter() - start
+    logger.info("Warmed up the grading pipeline in %.0f ms", elapsed * 1000)
+    return elapsed
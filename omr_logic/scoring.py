@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+
+# Pixels darker than this on the warped sheet count as ink.
+INK_THRESHOLD = 180
+
+
+def threshold_sheet(warped, out=None):
+    """
+    Threshold the whole warped sheet once into a 0/1 ink mask, written
+    into `out` if given.
+    """
+    if len(warped.shape) == 3:
+        gray = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = warped
+
+    _, mask = cv2.threshold(gray, INK_THRESHOLD, 1, cv2.THRESH_BINARY_INV, dst=out)
+    return mask
+
+
+def clamp_boxes(boxes, sheet_shape):
+    """
+    Clamp (x, y, w, h) question boxes so they lie inside the sheet,
+    the same way the per-question ROI loop used to.
+    """
+    sheet_h, sheet_w = sheet_shape[:2]
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    x, y, w, h = boxes.T
+
+    x = np.maximum(0, np.minimum(x, sheet_w - w))
+    y = np.maximum(0, np.minimum(y, sheet_h - h))
+    w = np.minimum(w, sheet_w - x)
+    h = np.minimum(h, sheet_h - y)
+
+    return np.stack([x, y, w, h], axis=1)
+
+
+def compute_fill_matrix(mask, boxes, options=4, integral=None):
+    """
+    Compute the ink fill ratio of every bubble on the sheet in one pass.
+
+    Each question box is split into `options` equal-width columns and the
+    ink inside each column is summed through an integral image, so the
+    cost is one cv2.integral call plus a handful of array lookups no
+    matter how many questions the sheet has.
+
+    `integral` is an optional preallocated int32 buffer one pixel larger
+    than the mask on each axis. Returns a float32 array of shape
+    (questions, options).
+    """
+    boxes = clamp_boxes(boxes, mask.shape)
+    integral = cv2.integral(mask, sum=integral)
+
+    x, y, w, h = (boxes[:, i:i + 1] for i in range(4))
+    option_width = w // options
+
+    x0 = x + option_width * np.arange(options)
+    x1 = x0 + option_width
+    y0 = np.broadcast_to(y, x0.shape)
+    y1 = np.broadcast_to(y + h, x0.shape)
+
+    filled = (integral[y1, x1] - integral[y0, x1]
+              - integral[y1, x0] + integral[y0, x0])
+    area = option_width * h
+
+    fills = np.zeros(filled.shape, dtype=np.float32)
+    np.divide(filled, area, out=fills, where=area > 0)
+    return fills
+
+
+def pick_answers(fills, min_fill=0.0):
+    """
+    Pick the most filled option for every question.
+
+    Returns an int8 array with the option index, or -1 where no option
+    is filled above `min_fill`.
+    """
+    answers = np.argmax(fills, axis=1).astype(np.int8)
+    best = fills[np.arange(len(fills)), answers]
+    answers[best <= min_fill] = -1
+    return answers
@@ -0,0 +1,173 @@
+"""
+Synthetic answer sheets with known answers, for benchmarking and
+accuracy checks.
+
+Sheets are drawn from the compiled layout, so they always match the
+bubble geometry the engine reads, then photographed onto a dark
+background with the distortions in DEFAULT_DISTORTION.
+"""
+import cv2
+import numpy as np
+
+from .layout import compile_layout
+
+# Mark kinds recorded in the ground truth
+BLANK, FULL, PARTIAL, DOUBLE = 0, 1, 2, 3
+MARK_KINDS = {BLANK: 'blank', FULL: 'full', PARTIAL: 'partial', DOUBLE: 'double'}
+
+DEFAULT_DISTORTION = {
+    'scale': 1.5,           # rendered sheet size relative to the layout's sheet_size
+    'skew': 0.03,           # max corner displacement, as a fraction of the sheet size
+    'rotation': 3.0,        # max in-plane rotation, degrees
+    'blur': 1.0,            # max Gaussian blur sigma, pixels
+    'noise': 6.0,           # sensor noise standard deviation, grey levels
+    'gradient': 0.3,        # max darkening across the sheet from uneven lighting (0-1)
+    'blank_rate': 0.02,     # fraction of questions left blank
+    'partial_rate': 0.03,   # fraction of questions with a small or faint mark
+    'double_rate': 0.01,    # fraction of questions with a second, lighter mark
+}
+
+# A sheet-fed scanner: every page lands in almost the same place, evenly lit
+SCANNER_DISTORTION = {
+    'skew': 0.002,
+    'rotation': 0.3,
+    'blur': 0.6,
+    'noise': 3.0,
+    'gradient': 0.05,
+}
+
+DISTORTION_PRESETS = {'photo': {}, 'scanner': SCANNER_DISTORTION}
+
+
+def _bubble_centres(layout, scale):
+    """(questions, options, 2) array of bubble centres at the rendered scale."""
+    x, y, w, h = (layout.boxes.astype(np.float32) * scale).T
+    step = w / layout.options
+    offsets = (np.arange(layout.options) + 0.5)[None, :]
+    cx = x[:, None] + step[:, None] * offsets
+    cy = np.repeat((y + h / 2)[:, None], layout.options, axis=1)
+    return np.stack([cx, cy], axis=-1), float(min(step.min(), h.min()) * 0.38)
+
+
+def random_answers(rng, layout, distortion=None):
+    """
+    Draw a ground truth for one sheet: (answers, kinds, extra) with the
+    intended option per question (-1 for blank), its MARK_KINDS code, and
+    the second option for double marks (-1 elsewhere).
+    """
+    d = dict(DEFAULT_DISTORTION, **(distortion or {}))
+    n = len(layout.boxes)
+    answers = rng.integers(0, layout.options, n).astype(np.int8)
+
+    roll = rng.random(n)
+    kinds = np.full(n, FULL, dtype=np.int8)
+    kinds[roll < d['blank_rate'] + d['partial_rate'] + d['double_rate']] = DOUBLE
+    kinds[roll < d['blank_rate'] + d['partial_rate']] = PARTIAL
+    kinds[roll < d['blank_rate']] = BLANK
+    answers[kinds == BLANK] = -1
+
+    extra = np.full(n, -1, dtype=np.int8)
+    doubles = np.flatnonzero(kinds == DOUBLE)
+    shift = rng.integers(1, layout.options, len(doubles))
+    extra[doubles] = (answers[doubles] + shift) % layout.options
+    return answers, kinds, extra
+
+
+def render_sheet(layout, answers, kinds, extra, rng, scale=1.0):
+    """Draw a flat, undistorted grayscale sheet with the given marks."""
+    width, height = (int(round(v * scale)) for v in layout.sheet_size)
+    sheet = np.full((height, width), 250, dtype=np.uint8)
+    centres, radius = _bubble_centres(layout, scale)
+    r = max(int(round(radius)), 2)
+
+    for q in range(len(centres)):
+        for o in range(layout.options):
+            cx, cy = (int(round(v)) for v in centres[q, o])
+            cv2.circle(sheet, (cx, cy), r, 90, 1, cv2.LINE_AA)
+
+        if kinds[q] == BLANK:
+            continue
+        cx, cy = (int(round(v)) for v in centres[q, answers[q]])
+        if kinds[q] == PARTIAL:
+            # A hurried tick or a light pencil fill
+            if rng.random() < 0.5:
+                cv2.circle(sheet, (cx, cy), max(r // 2, 1), int(rng.integers(30, 80)), -1, cv2.LINE_AA)
+            else:
+                cv2.circle(sheet, (cx, cy), r, int(rng.integers(120, 170)), -1, cv2.LINE_AA)
+        else:
+            cv2.circle(sheet, (cx, cy), r, int(rng.integers(20, 60)), -1, cv2.LINE_AA)
+        if kinds[q] == DOUBLE:
+            # An erased or half-hearted second answer
+            cx, cy = (int(round(v)) for v in centres[q, extra[q]])
+            cv2.circle(sheet, (cx, cy), r, int(rng.integers(130, 175)), -1, cv2.LINE_AA)
+    return sheet
+
+
+def photograph(sheet, rng, distortion=None):
+    """
+    Place a flat sheet on a dark background as a camera would see it:
+    perspective skew, rotation, uneven lighting, blur and noise.
+    Returns a BGR image.
+    """
+    d = dict(DEFAULT_DISTORTION, **(distortion or {}))
+    h, w = sheet.shape
+    margin_x, margin_y = int(w * 0.15), int(h * 0.12)
+    out_w, out_h = w + 2 * margin_x, h + 2 * margin_y
+
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    jitter = rng.uniform(-d['skew'], d['skew'], (4, 2)) * [w, h]
+    dst = src + [margin_x, margin_y] + jitter
+
+    angle = np.deg2rad(rng.uniform(-d['rotation'], d['rotation']))
+    centre = np.float32([out_w / 2, out_h / 2])
+    rot = np.float32([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    dst = ((dst - centre) @ rot.T + centre).astype(np.float32)
+
+    background = int(rng.integers(25, 90))
+    canvas = np.full((out_h, out_w), background, dtype=np.uint8)
+    matrix = cv2.getPerspectiveTransform(src, dst)
+    image = cv2.warpPerspective(sheet, matrix, (out_w, out_h), dst=canvas,
+                                borderMode=cv2.BORDER_TRANSPARENT).astype(np.float32)
+
+    if d['gradient'] > 0:
+        direction = rng.uniform(-1, 1, 2)
+        yy, xx = np.mgrid[0:out_h, 0:out_w].astype(np.float32)
+        ramp = (xx / out_w - 0.5) * direction[0] + (yy / out_h - 0.5) * direction[1]
+        ramp = (ramp - ramp.min()) / max(float(np.ptp(ramp)), 1e-6)
+        image *= 1.0 - rng.uniform(0, d['gradient']) * ramp
+
+    sigma = rng.uniform(0, d['blur'])
+    if sigma > 0.1:
+        image = cv2.GaussianBlur(image, (0, 0), sigma)
+    if d['noise'] > 0:
+        image += rng.normal(0, d['noise'], image.shape).astype(np.float32)
+
+    gray = np.clip(image, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def make_sheet(rng, layout_id=None, distortion=None):
+    """
+    Generate one photographed sheet.
+
+    Returns (image, truth) where truth is a dict with the layout id and
+    the `answers`, `kinds` and `extra` arrays from random_answers.
+    """
+    d = dict(DEFAULT_DISTORTION, **(distortion or {}))
+    layout = compile_layout(layout_id)
+    answers, kinds, extra = random_answers(rng, layout, d)
+    sheet = render_sheet(layout, answers, kinds, extra, rng, scale=d['scale'])
+    image = photograph(sheet, rng, d)
+    truth = {'layout_id': layout.layout_id, 'answers': answers, 'kinds': kinds, 'extra': extra}
+    return image, truth
+
+
+def generate_corpus(count, seed=0, layout_id=None, distortion=None):
+    """
+    Yield (index, image, truth) for `count` sheets. The same seed always
+    produces the same corpus, so runs of the benchmark are comparable.
+    """
+    for index in range(count):
+        rng = np.random.default_rng([seed, index])
+        image, truth = make_sheet(rng, layout_id, distortion)
+        yield index, image, truth
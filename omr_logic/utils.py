@@ -1,25 +1,186 @@
+import os
+import struct
+
 import cv2
 import numpy as np
 
-def get_sheet_outline(image):
+from .layout import compile_layout
+
+# 'full' decodes uploads to BGR at native size. 'reduced' decodes straight
+# to grayscale and, for JPEGs, lets libjpeg scale by 1/2, 1/4 or 1/8 while
+# decoding, as long as the image stays at least the canonical sheet size.
+DECODE_MODES = ('full', 'reduced')
+DECODE_MODE = os.environ.get('OMR_DECODE_MODE', 'reduced').lower()
+if DECODE_MODE not in DECODE_MODES:
+    raise ValueError(f"OMR_DECODE_MODE must be one of {', '.join(DECODE_MODES)}, not '{DECODE_MODE}'")
+
+# Decoded pixels to keep per canonical sheet pixel, on each side
+REDUCED_DECODE_OVERSAMPLE = float(os.environ.get('OMR_DECODE_OVERSAMPLE', '1.0'))
+
+REDUCED_GRAYSCALE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, arithmetic)
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def image_header(data):
+    """
+    Read (format, width, height) from a JPEG or PNG header without
+    decoding any pixels. Returns None for other formats or a truncated
+    header.
+    """
+    if data[:8] == _PNG_SIGNATURE and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height
+
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # no length field
+            pos += 2
+            continue
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return 'jpeg', width, height
+        pos += 2 + length
+    return None
+
+
+def reduced_decode_factor(width, height, target_size, oversample=REDUCED_DECODE_OVERSAMPLE):
+    """
+    Largest of 8, 4 or 2 that keeps a width x height image at least
+    `oversample` times `target_size` on both sides (orientation-free),
+    else 1.
+    """
+    long_side, short_side = max(width, height), min(width, height)
+    target_long, target_short = (max(target_size) * oversample, min(target_size) * oversample)
+    for factor, _ in REDUCED_GRAYSCALE_FLAGS:
+        if long_side // factor >= target_long and short_side // factor >= target_short:
+            return factor
+    return 1
+
+
+def decode_flags(data, mode=None, layout_id=None):
+    """OpenCV imdecode flag for `data` under the given decode mode."""
+    if (mode or DECODE_MODE) != 'reduced':
+        return cv2.IMREAD_COLOR
+    header = image_header(data)
+    # Only JPEG decoding scales natively; OpenCV would decode other
+    # formats at full size and then resize without antialiasing
+    if header is not None and header[0] == 'jpeg':
+        factor = reduced_decode_factor(header[1], header[2], compile_layout(layout_id).sheet_size)
+        for candidate, flag in REDUCED_GRAYSCALE_FLAGS:
+            if candidate == factor:
+                return flag
+    return cv2.IMREAD_GRAYSCALE
+
+
+def decode_image(data, mode=None, layout_id=None):
+    """
+    Decode encoded image bytes (JPEG, PNG, ...). In 'full' mode the
+    result is a BGR array at native size; in 'reduced' mode (the default,
+    see OMR_DECODE_MODE) it is grayscale, possibly scaled down for the
+    canonical sheet size of `layout_id`. Returns None if the bytes are not
+    a readable image.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, decode_flags(data, mode, layout_id))
+
+# Longest side, in pixels, of the copy used for outline detection in auto mode
+OUTLINE_DETECT_SIZE = 1000
+
+def outline_downscale_factor(image, max_side=OUTLINE_DETECT_SIZE):
+    """
+    Pick the downscale factor for outline detection from the image size,
+    so the detection copy's longest side is at most `max_side`.
+    """
+    return max(1.0, max(image.shape[:2]) / float(max_side))
+
+def _buffer(buffers, shape, dtype=np.uint8):
+    """A leased output buffer, or None to let OpenCV allocate one."""
+    return buffers.get(shape, dtype) if buffers is not None else None
+
+def _find_quadrilateral(gray, buffers=None):
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0, dst=_buffer(buffers, gray.shape))
+    edged = cv2.Canny(blurred, 75, 200, edges=_buffer(buffers, gray.shape))
+
+    # findContours no longer modifies its input (OpenCV >= 3.2), so no copy
+    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+
+    for contour in contours:
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
+
+        if len(approx) == 4:
+            return approx.reshape(4, 2)
+
+    return None
+
+def refine_corners(gray, corners, scale):
+    """
+    Refine corners found on a downscaled copy against the full-resolution
+    image. The search window covers the rounding error of the downscale;
+    a corner that drifts outside it keeps its scaled-up position.
+    """
+    half_window = max(3, int(round(2 * scale)))
+    refined = corners.astype(np.float32).reshape(-1, 1, 2).copy()
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.1)
+    cv2.cornerSubPix(gray, refined, (half_window, half_window), (-1, -1), criteria)
+    refined = refined.reshape(4, 2)
+
+    drift = np.linalg.norm(refined - corners, axis=1)
+    return np.where((drift <= half_window)[:, None], refined, corners).astype(np.float32)
+
+def get_sheet_outline(image, downscale='auto', refine=True, buffers=None):
     """
     Detect the outline/corners of the OMR sheet.
+
+    The quadrilateral is searched on a copy shrunk by `downscale` ('auto'
+    picks the factor from the image size, 1 disables it) and its corners
+    are scaled back up, then optionally refined locally at full resolution.
+    Intermediate images are taken from `buffers` (a buffer pool lease)
+    when given.
     """
     try:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        edged = cv2.Canny(blurred, 75, 200)
-        
-        contours, _ = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
-        
-        for contour in contours:
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            if len(approx) == 4:
-                return approx.reshape(4, 2)
-        
+        if image.ndim == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=_buffer(buffers, image.shape[:2]))
+        else:
+            gray = image
+
+        scale = outline_downscale_factor(gray) if downscale == 'auto' else max(1.0, float(downscale))
+        if scale > 1:
+            # Same size cv2.resize derives from fx/fy, so the buffer is used as is
+            small_shape = (int(round(gray.shape[0] / scale)), int(round(gray.shape[1] / scale)))
+            small = cv2.resize(gray, None, dst=_buffer(buffers, small_shape), fx=1 / scale, fy=1 / scale,
+                               interpolation=cv2.INTER_AREA)
+        else:
+            small = gray
+
+        corners = _find_quadrilateral(small, buffers)
+        if corners is not None:
+            if scale == 1:
+                return corners
+            corners = corners.astype(np.float32) * scale
+            return refine_corners(gray, corners, scale) if refine else corners
+
         h, w = image.shape[:2]
         return np.array([[0, 0], [w, 0], [w, h], [0, h]])
         
@@ -28,31 +189,42 @@ def get_sheet_outline(image):
         h, w = image.shape[:2]
         return np.array([[0, 0], [w, 0], [w, h], [0, h]])
 
-def get_warped_image(image, corners):
+def get_warped_image(image, corners, size=None, grayscale=False, interpolation=cv2.INTER_LINEAR, dst=None):
     """
     Apply perspective transformation.
+
+    By default the output size follows the detected corners. Pass `size`
+    as (width, height) to warp straight to a fixed canonical resolution,
+    and `grayscale=True` to warp a single channel instead of BGR. `dst`
+    is an optional preallocated output of the right shape.
     """
     try:
         corners = order_points(corners)
+
+        if grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        if size is not None:
+            width, height = size
+        else:
+            width = max(
+                np.linalg.norm(corners[1] - corners[0]), 
+                np.linalg.norm(corners[2] - corners[3])
+            )
+            height = max(
+                np.linalg.norm(corners[3] - corners[0]), 
+                np.linalg.norm(corners[2] - corners[1])
+            )
         
-        width = max(
-            np.linalg.norm(corners[1] - corners[0]), 
-            np.linalg.norm(corners[2] - corners[3])
-        )
-        height = max(
-            np.linalg.norm(corners[3] - corners[0]), 
-            np.linalg.norm(corners[2] - corners[1])
-        )
-        
-        dst = np.array([
+        dst_points = np.array([
             [0, 0],
             [width - 1, 0],
             [width - 1, height - 1],
             [0, height - 1]
         ], dtype=np.float32)
         
-        matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), dst)
-        warped = cv2.warpPerspective(image, matrix, (int(width), int(height)))
+        matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), dst_points)
+        warped = cv2.warpPerspective(image, matrix, (int(width), int(height)), dst=dst, flags=interpolation)
         
         return warped
         
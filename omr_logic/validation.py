@@ -0,0 +1,49 @@
+import cv2
+
+from .buffers import get_buffer_pool
+from .quality import describe_problems, make_thumbnail, quality_gate
+
+def basic_image_validation(image, quality_mode=None):
+    """
+    Sanity-check an image before evaluation. Accepts a decoded array, or
+    a file path for callers that still work from disk.
+
+    All checks run on a small thumbnail. Besides the uniform / white /
+    black checks, the quality gate rejects (or, in 'flag' mode, only
+    reports) dark, washed-out, blurry and sheet-less photos.
+    """
+    try:
+        if isinstance(image, str):
+            image = cv2.imread(image)
+        if image is None:
+            return False, "Cannot read image file. File may be corrupted."
+
+        height, width = image.shape[:2]
+
+        if width < 100 or height < 100:
+            return False, f"Image too small ({width}x{height}). Please use a larger image."
+
+        with get_buffer_pool().lease() as buffers:
+            thumb = make_thumbnail(image, buffers=buffers)
+            mean, std = cv2.meanStdDev(thumb)
+            mean_intensity, std_intensity = float(mean[0, 0]), float(std[0, 0])
+
+            if std_intensity < 1:
+                return False, "Image appears to be completely uniform (no content detected)."
+
+            if mean_intensity > 254:
+                return False, "Image is completely white."
+
+            if mean_intensity < 1:
+                return False, "Image is completely black."
+
+            accepted, report = quality_gate(image, quality_mode, thumbnail=thumb, buffers=buffers)
+        if not accepted:
+            return False, f"Image failed quality checks: {describe_problems(report)}."
+
+        message = f"Image accepted for processing (size: {width}x{height}, brightness: {mean_intensity:.0f})"
+        if report is not None and not report.passed:
+            message += f". Quality warnings: {describe_problems(report)}"
+        return True, message
+    except Exception as e:
+        return False, f"Error processing image: {str(e)}"
@@ -1,6 +1,9 @@
 #!/bin/bash
-# Run database initialization
-python -c "from app import init_db; init_db()"
+# Start the grading job workers for /api/jobs, if requested
+if [ -n "$OMR_JOB_WORKERS" ]; then
+    python -m omr_logic.jobs --workers "$OMR_JOB_WORKERS" &
+fi
 
-# Start the Gunicorn server
-gunicorn --bind 0.0.0.0:$PORT app:app
\ No newline at end of file
+# Start the Gunicorn server; gunicorn.conf.py preloads the app (which
+# initialises the database), budgets native threads and warms up workers
+gunicorn -c gunicorn.conf.py app:app
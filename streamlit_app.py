@@ -1,35 +1,312 @@
+import csv
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import streamlit as st
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 st.set_page_config(page_title="OMR Evaluation", layout="centered")
 st.title("Automated OMR Evaluation System")
 
 
 
-BACKEND = "http://localhost:5000"
+# "remote" sends sheets to the Flask backend over HTTP; "embedded" grades
+# them in this process with the same engine the backend uses
+ENGINE_MODE = os.environ.get("OMR_STREAMLIT_ENGINE", "remote").lower()
+BACKEND = os.environ.get("OMR_BACKEND_URL", "http://localhost:5000")
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TYPES = ["jpg", "jpeg", "png", "bmp", "tiff"]
+MAX_CONCURRENT_UPLOADS = 8
+UPLOAD_ATTEMPTS = 3       # per sheet, for connection errors and RETRY_STATUSES
+RETRY_BACKOFF = 0.5       # seconds, doubled after each failed attempt
+MAX_RETRY_AFTER = 30      # longest server-requested wait (503 Retry-After) honoured, seconds
+# Busy or unreachable backend; other errors (e.g. a 500 EVALUATION_ERROR) recur on every attempt
+RETRY_STATUSES = {502, 503, 504}
+
+@st.cache_resource
+def get_session():
+    """
+    One HTTP session per Streamlit server, shared by every upload thread,
+    so sheets go over pooled keep-alive connections instead of a new TCP
+    connection each. Only connection failures are retried here; POSTs
+    that reached the server are retried per sheet by upload_sheet().
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_CONCURRENT_UPLOADS,
+        max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=RETRY_BACKOFF),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_engine():
+    """
+    The grading engine for embedded mode, created once per Streamlit
+    server: answer keys, compiled layouts, result cache and database are
+    loaded here and shared by every session and upload thread.
+    """
+    from omr_logic.engine import GradingEngine
+    from omr_logic.runtime import warm_up
+
+    engine = GradingEngine()
+    try:
+        warm_up(engine.answer_keys)
+    except Exception:
+        # Only costs the first sheet some latency
+        logger.warning("Engine warm-up failed", exc_info=True)
+    return engine
 
 @st.cache_data(ttl=30)
 def load_versions():
+    if ENGINE_MODE == "embedded":
+        return get_engine().answer_keys.versions()
     try:
-        r = requests.get(f"{BACKEND}/api/versions", timeout=5)
+        r = get_session().get(f"{BACKEND}/api/versions", timeout=5)
         r.raise_for_status()
         return r.json()
     except Exception:
         return []
 
+def retry_delay(resp, attempt):
+    """
+    Seconds to wait before the next attempt: the server's Retry-After
+    when it is shedding load (503), capped at MAX_RETRY_AFTER, else
+    exponential backoff.
+    """
+    if resp is not None and resp.status_code == 503:
+        try:
+            return min(max(float(resp.headers["Retry-After"]), 0.0), MAX_RETRY_AFTER)
+        except (KeyError, ValueError):
+            pass
+    return RETRY_BACKOFF * 2 ** (attempt - 1)
+
+def post_sheet(session, files, data):
+    """
+    POST one sheet to /api/upload, retrying connection errors and
+    RETRY_STATUSES. Returns (last response or None, error message or None,
+    attempts made).
+    """
+    error = None
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        resp = None
+        try:
+            resp = session.post(f"{BACKEND}/api/upload", files=files, data=data, timeout=60)
+        except requests.exceptions.RequestException as e:
+            error = f"Request failed: {e}"
+        else:
+            # Any other status is the server's answer for this sheet; sending it again will not help
+            if resp.status_code not in RETRY_STATUSES:
+                return resp, None, attempt
+            error = f"Server Error {resp.status_code}"
+        if attempt < UPLOAD_ATTEMPTS:
+            time.sleep(retry_delay(resp, attempt))
+    return resp, error, UPLOAD_ATTEMPTS
+
+def evaluate_sheet(filename, data, student_id, version):
+    """
+    Grade one sheet through the configured engine: in-process when
+    embedded, else via /api/upload (see post_sheet). Returns (HTTP status,
+    response body, attempts made); the status is None when no usable
+    response came back, and the body then holds just the error.
+    """
+    if ENGINE_MODE == "embedded":
+        body, status = get_engine().grade(data, filename, student_id, version, route="embedded")
+        return status, body, 1
+
+    resp, error, attempts = post_sheet(
+        get_session(), {"file": (filename, data)}, {"student_id": student_id, "version": version}
+    )
+    if resp is None:
+        return None, {"error": error}, attempts
+    try:
+        return resp.status_code, resp.json(), attempts
+    except json.JSONDecodeError:
+        return None, {"error": f"Server Error {resp.status_code}", "details": resp.text}, attempts
+
+def upload_sheet(filename, data, student_id, version):
+    """
+    Evaluate one sheet (see evaluate_sheet). Returns (result JSON or
+    None, error message or None, attempts made). Runs on an upload thread.
+    """
+    status, body, attempts = evaluate_sheet(filename, data, student_id, version)
+    # 202: graded, with the database commit still pending (sync=1 timed out)
+    if status in (200, 202):
+        return body, None, attempts
+    return None, body.get("details") or body.get("error") or f"Server Error {status}", attempts
+
+def parse_roster(uploaded):
+    """Read a roster CSV/JSON into {filename: {'student_id', 'version'}}."""
+    text = uploaded.getvalue().decode("utf-8-sig")
+    if uploaded.name.lower().endswith(".json"):
+        rows = json.loads(text)
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    return {
+        (row.get("filename") or "").strip(): {
+            "student_id": (row.get("student_id") or "").strip(),
+            "version": (row.get("version") or "").strip(),
+        }
+        for row in rows if (row.get("filename") or "").strip()
+    }
+
+def upload_row(row, data):
+    """Upload one batch row and record the outcome on it. Runs on an upload thread."""
+    row["status"] = "uploading"
+    result, error, attempts = upload_sheet(row["file"], data, row["student_id"], row["version"])
+    row["attempts"] += attempts
+    if result is not None:
+        row.update(status="done", error="", total_score=result.get("total_score"),
+                   max_score=result.get("max_possible_score"), scores=result.get("scores", {}))
+    else:
+        row.update(status="failed", error=error)
+
+def run_uploads(rows, files, concurrency, table):
+    """
+    Upload the sheets of `rows` that are not done yet, at most
+    `concurrency` at a time, redrawing `table` as sheets finish. Upload
+    threads only touch the plain `rows` dicts; all drawing happens here,
+    on the script thread.
+    """
+    todo = [row for row in rows if row["status"] != "done"]
+    for row in todo:
+        row.update(status="queued", error="")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = {pool.submit(upload_row, row, files[row["file"]]) for row in todo}
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+            show_batch_table(rows, table)
+
+def show_batch_table(rows, table):
+    table.dataframe(
+        [
+            {
+                "File": row["file"],
+                "Student ID": row["student_id"],
+                "Version": row["version"],
+                "Status": row["status"],
+                "Score": "" if row.get("total_score") is None else f"{row['total_score']}/{row['max_score']}",
+                **row.get("scores", {}),
+                "Attempts": row["attempts"],
+                "Error": row["error"],
+            }
+            for row in rows
+        ],
+        use_container_width=True,
+        hide_index=True,
+    )
+
+def batch_results_csv(rows):
+    out = io.StringIO()
+    subjects = sorted({name for row in rows for name in row.get("scores", {})})
+    writer = csv.writer(out)
+    writer.writerow(["filename", "student_id", "version", "status", "total_score", "max_possible_score"]
+                    + subjects + ["error"])
+    for row in rows:
+        writer.writerow([row["file"], row["student_id"], row["version"], row["status"],
+                         row.get("total_score", ""), row.get("max_score", "")]
+                        + [row.get("scores", {}).get(name, "") for name in subjects] + [row["error"]])
+    return out.getvalue()
+
+def batch_mode(versions):
+    """Evaluate many sheets at once, matched to students through a roster."""
+    uploaded_files = st.file_uploader(
+        "Upload OMR Sheet Images",
+        type=IMAGE_TYPES,
+        accept_multiple_files=True,
+        help="Images of filled OMR sheets.",
+    )
+    roster_file = st.file_uploader(
+        "Roster (optional)",
+        type=["csv", "json"],
+        help="CSV or JSON with filename, student_id and optionally version columns.",
+    )
+    default_version = st.selectbox("Exam Version", versions if versions else ["--"],
+                                   help="Used for sheets the roster does not assign a version.")
+    use_filenames = st.checkbox("Use the file name as student ID for sheets not on the roster", value=not roster_file)
+    concurrency = st.slider("Concurrent uploads", 1, MAX_CONCURRENT_UPLOADS, 4)
+
+    files = {f.name: f.getvalue() for f in uploaded_files or []}
+    roster = {}
+    if roster_file is not None:
+        try:
+            roster = parse_roster(roster_file)
+        except (ValueError, UnicodeDecodeError) as e:
+            st.error(f"Could not read the roster: {e}")
+            return
+
+    col1, col2 = st.columns(2)
+    start = col1.button("Evaluate Batch", disabled=not files)
+    rows = st.session_state.get("batch_rows", [])
+    retry = col2.button("Retry Failed", disabled=not any(row["status"] == "failed" for row in rows))
+    table = st.empty()
+
+    if start:
+        rows = []
+        for name in files:
+            entry = roster.get(name, {})
+            student_id = entry.get("student_id") or (os.path.splitext(name)[0] if use_filenames else "")
+            version = entry.get("version") or default_version
+            row = {"file": name, "student_id": student_id, "version": version,
+                   "status": "queued", "attempts": 0, "error": ""}
+            if not student_id or version in ("--", None):
+                row.update(status="skipped", error="No student ID or version for this sheet")
+            rows.append(row)
+        st.session_state["batch_rows"] = rows
+
+    if start or retry:
+        # Files removed from the uploader since the first run cannot be resent
+        runnable = [row for row in rows if row["status"] != "skipped" and row["file"] in files]
+        run_uploads(runnable, files, concurrency, table)
+
+    if rows:
+        show_batch_table(rows, table)
+        done = sum(row["status"] == "done" for row in rows)
+        failed = sum(row["status"] == "failed" for row in rows)
+        st.write(f"{done} of {len(rows)} sheets evaluated, {failed} failed.")
+        st.download_button("Download Results (CSV)", batch_results_csv(rows),
+                           file_name="omr_results.csv", mime="text/csv")
+
+def render_footer():
+    st.markdown('''
+<div class="footer">
+    <p>🎯 <strong>OMR Evaluation System</strong> • Developed by <strong>Vedant Patil</strong></p>
+
+</div>
+''', unsafe_allow_html=True)
+
 versions = load_versions()
 
 # Display a warning if the backend is not accessible
-if not versions:
+if not versions and ENGINE_MODE == "embedded":
+    st.error("No answer keys loaded. Check data/answer_keys.json.")
+elif not versions:
     st.error("Could not connect to the backend. Please ensure the Flask server is running.")
 
+mode = st.radio("Mode", ["Single sheet", "Batch"], horizontal=True)
+if mode == "Batch":
+    batch_mode(versions)
+    render_footer()
+    st.stop()
+
 with st.form("omr_form"):
     student_id = st.text_input("Student ID")
     version = st.selectbox("Exam Version", versions if versions else ["--"])
     uploaded_file = st.file_uploader(
         "Upload OMR Sheet Image",
-        type=["jpg", "jpeg", "png", "bmp", "tiff"],
+        type=IMAGE_TYPES,
         help="Image of filled OMR sheet."
     )
     submit = st.form_submit_button("Evaluate Sheet")
@@ -38,93 +315,70 @@ if submit:
     if not student_id or not uploaded_file or version in ("--", None):
         st.error("All fields required.")
     else:
-        files = {"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)}
-        
-        # Data sent to the backend remains simplified as per your previous request
-        data = {
-            "student_id": student_id,
-            "version": version
-        }
-        
         with st.spinner("Evaluating..."):
-            try:
-                resp = requests.post(f"{BACKEND}/api/upload", files=files, data=data, timeout=60)
-            except requests.exceptions.RequestException as e:
-                st.error(f"Request failed: {e}")
-            else:
-                if resp.status_code == 200:
-                    try:
-                        result = resp.json()
-                    except json.JSONDecodeError:
-                        st.error("Invalid JSON from server.")
-                        st.code(resp.text)
-                    else:
-                        st.success("OMR Sheet Successfully Evaluated!")
-                        st.subheader(f"Results for Student ID: {result.get('student_id')}")
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.metric(
-                                "Total Score",
-                                str(result.get("total_score", 0)),
-                                f"out of {result.get('max_possible_score', 0)}"
-                            )
-                        with col2:
-                            max_score = result.get("max_possible_score", 1) or 1
-                            pct = (result.get("total_score", 0) / max_score) * 100
-                            st.metric("Percentage", f"{pct:.1f}%")
-
-                        st.write(f"Sheet Version: {result.get('version')}")
-
-                        if "warnings" in result:
-                            for w in result["warnings"]:
-                                st.warning(w)
-
-                        st.subheader("Subject-wise Scores")
-                        scores = result.get("scores", {})
+            status, body, _ = evaluate_sheet(uploaded_file.name, uploaded_file.getvalue(), student_id, version)
+            if status is None:
+                st.error(body["error"])
+                if body.get("details"):
+                    st.code(body["details"])
+            elif status in (200, 202):
+                result = body
+                st.success("OMR Sheet Successfully Evaluated!")
+                st.subheader(f"Results for Student ID: {result.get('student_id')}")
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.metric(
+                        "Total Score",
+                        str(result.get("total_score", 0)),
+                        f"out of {result.get('max_possible_score', 0)}"
+                    )
+                with col2:
+                    max_score = result.get("max_possible_score", 1) or 1
+                    pct = (result.get("total_score", 0) / max_score) * 100
+                    st.metric("Percentage", f"{pct:.1f}%")
+
+                st.write(f"Sheet Version: {result.get('version')}")
+
+                if "warnings" in result:
+                    for w in result["warnings"]:
+                        st.warning(w)
+
+                st.subheader("Subject-wise Scores")
+                scores = result.get("scores", {})
                         
-                        # --- MODIFICATION STARTS HERE ---
-                        # Get the default subject questions per subject from the answer key.
-                        # Assuming all subjects in a given version have the same number of questions.
-                        # You can make this dynamic if subjects have different question counts.
-                        default_qps = 20 # This was hardcoded in your previous request
+                # --- MODIFICATION STARTS HERE ---
+                # Get the default subject questions per subject from the answer key.
+                # Assuming all subjects in a given version have the same number of questions.
+                # You can make this dynamic if subjects have different question counts.
+                default_qps = 20 # This was hardcoded in your previous request
                         
-                        # Fetch the actual answer key for the selected version to get correct question counts
-                        # This would require another API call or a modification to the /api/versions endpoint
-                        # For now, let's keep it simple and assume 20 questions per subject based on your ANSWER_KEYS structure.
+                # Fetch the actual answer key for the selected version to get correct question counts
+                # This would require another API call or a modification to the /api/versions endpoint
+                # For now, let's keep it simple and assume 20 questions per subject based on your ANSWER_KEYS structure.
                         
-                        # Iterate through the scores dictionary directly.
-                        # The keys of 'scores' already contain the correct subject names from your Flask backend.
-                        for subject_name, score in scores.items():
-                            percent = (score / default_qps) * 100 if default_qps else 0
-                            c1, c2, c3 = st.columns([3, 1, 1])
-                            with c1:
-                                st.write(f"{subject_name}") # Use subject_name directly
-                            with c2:
-                                st.write(f"{score}/{default_qps}")
-                            with c3:
-                                st.write(f"{percent:.1f}%")
-                        # --- MODIFICATION ENDS HERE ---
-
-                        with st.expander("Raw Result Data"):
-                            st.json(result)
-                else:
-                    try:
-                        err = resp.json()
-                    except json.JSONDecodeError:
-                        st.error(f"Server Error {resp.status_code}")
-                        st.code(resp.text)
-                    else:
-                        st.error("An error occurred during evaluation.")
-                        if "details" in err:
-                            st.write(f"Details: {err['details']}")
-                        if "suggestions" in err:
-                            st.info("Suggestions:")
-                            for s in err.get("suggestions", []):
-                                st.write(f"- {s}")
-                                 # Footer
-st.markdown('''
-<div class="footer">
-    <p>🎯 <strong>OMR Evaluation System</strong> • Developed by <strong>Vedant Patil</strong></p>
+                # Iterate through the scores dictionary directly.
+                # The keys of 'scores' already contain the correct subject names from your Flask backend.
+                for subject_name, score in scores.items():
+                    percent = (score / default_qps) * 100 if default_qps else 0
+                    c1, c2, c3 = st.columns([3, 1, 1])
+                    with c1:
+                        st.write(f"{subject_name}") # Use subject_name directly
+                    with c2:
+                        st.write(f"{score}/{default_qps}")
+                    with c3:
+                        st.write(f"{percent:.1f}%")
+                # --- MODIFICATION ENDS HERE ---
 
-</div>
-''', unsafe_allow_html=True)
\ No newline at end of file
+                with st.expander("Raw Result Data"):
+                    st.json(result)
+            else:
+                err = body
+                st.error("An error occurred during evaluation.")
+                if "details" in err:
+                    st.write(f"Details: {err['details']}")
+                if "suggestions" in err:
+                    st.info("Suggestions:")
+                    for s in err.get("suggestions", []):
+                        st.write(f"- {s}")
+                                 # Footer
+render_footer()
\ No newline at end of file